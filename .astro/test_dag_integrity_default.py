@@ -1,8 +1,11 @@
 """Test the validity of all DAGs. **USED BY DEV PARSE COMMAND DO NOT EDIT**"""
 
 from contextlib import contextmanager
+from glob import glob
 import logging
 import os
+import subprocess
+import sys
 
 import pytest
 
@@ -139,3 +142,42 @@ def test_file_imports(rel_path, rv):
     else:
         # If rv is "No import errors," consider it a passed test
         print(f"{rel_path} passed the import test")
+
+
+# =========== DAG PARSE TIME BUDGET ===========
+# The scheduler parses every DAG file in a loop, heavy imports belong inside the task callables.
+DAG_PARSE_BUDGET_SECONDS = float(os.environ.get("DAG_PARSE_BUDGET_SECONDS", "2"))
+HEAVY_MODULES = ("polars", "joblib", "include.tasks.dag_tasks")
+
+
+def get_dag_parse_times():
+    """
+    Generate a tuple of the parse duration in seconds for every dag file in the dag bag
+    """
+    with suppress_logging("airflow"):
+        dag_bag = DagBag(include_examples=False)
+        return [(stat.file.lstrip("/"), stat.duration.total_seconds()) for stat in dag_bag.dagbag_stats]
+
+
+@pytest.mark.parametrize(
+    "rel_path, duration", get_dag_parse_times(), ids=[x[0] for x in get_dag_parse_times()]
+)
+def test_file_parse_time(rel_path, duration):
+    """Test that a dag file is parsed within the budget"""
+    print(f"{rel_path} parsed in {duration:.3f} sec (budget {DAG_PARSE_BUDGET_SECONDS} sec)")
+    if duration > DAG_PARSE_BUDGET_SECONDS:
+        raise Exception(f"{rel_path} took {duration:.3f} sec to parse, the budget is {DAG_PARSE_BUDGET_SECONDS} sec")
+
+
+@pytest.mark.parametrize("dag_file", sorted(glob("dags/*.py")))
+def test_file_does_not_import_heavy_modules(dag_file):
+    """Test that parsing a dag file does not import the modules of the tasks"""
+    code = (
+        "import runpy, sys; "
+        f"runpy.run_path({dag_file!r}); "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    imported = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+    if imported:
+        raise Exception(f"{dag_file} imports {imported} at parse time, import them inside the task callables")
@@ -2,15 +2,29 @@ import sys
 import pendulum
 local_tz = pendulum.timezone("Europe/Berlin")
 from datetime import timedelta
-from pathlib import Path  
 from airflow.decorators import dag, task
 
-sys.path.append(Path("/usr/local/airflow/include/scripts/"))
- 
-from include.tasks.dag_tasks import get_today_transactionSales
-from include.tasks.dag_tasks import get_stockes_from_api
-from include.tasks.dag_tasks import get_article_stock_all_stores
-from include.tasks.dag_tasks import stock_diff
+sys.path.append("/usr/local/airflow/include/scripts/")
+
+# The task functions (polars, numpy, joblib, requests, sqlalchemy) are imported inside the task callables only,
+    # the scheduler parses this file in a loop and must not pay for these imports.
+
+# Number of shards of the stock crawl. 0 runs the crawl in one task, K > 0 splits the articles into K mapped tasks
+    # which can run on any Celery worker, followed by a task that merges them into the snapshot.
+NUM_STOCK_SHARDS = 0
+# Memory budget in MB of the stock ingestion and the pivot task. None keeps everything in memory,
+    # a budget processes the articles in bounded batches and spills to disk (the workers are limited to 8G).
+MEMORY_BUDGET_MB = None
+# Settings of the adaptive limit of in-flight API requests (include/concurrency.py), e.g. {"initial_limit": 4, "max_limit": 32}. None uses the defaults.
+STOCK_API_CONCURRENCY = None
+# True builds the pivot as one lazy plan which is sunk into the parquet file by the streaming engine, False pivots in memory.
+STOCK_PIVOT_STREAMING = False
+# 'wide' saves the store columns on every row of the snapshot (pivotArtStoresStock),
+    # 'normalized' saves the article/size x store matrix once (pivotMatrix), the diff task builds the wide view from it.
+STOCK_STORAGE_MODE = 'wide'
+# Wall-clock deadline 'HH:MM' of the stock crawl. The articles are fetched by priority (recent sales, stock changes, new articles),
+    # at the deadline a partial snapshot is published and the rest is fetched by the follow-up task. None fetches all articles before publishing.
+STOCK_CRAWL_DEADLINE = None
   
 # Define default args
 default_args = {
@@ -28,23 +42,66 @@ def ETL():
     # Task 1        
     @task(task_id='get_stocks_from_API')
     def stock_():
-        get_stockes_from_api(customer='22001')
+        from include.tasks.dag_tasks import get_stockes_from_api
+        get_stockes_from_api(customer='22001', concurrency=STOCK_API_CONCURRENCY, memory_budget_mb=MEMORY_BUDGET_MB, deadline=STOCK_CRAWL_DEADLINE)
+
+    # Task 1, follow-up pass of a crawl with deadline
+    @task(task_id='complete_stock_crawl')
+    def complete_stocks():
+        from include.tasks.dag_tasks import complete_stock_crawl
+        complete_stock_crawl(customer='22001', concurrency=STOCK_API_CONCURRENCY, streaming=STOCK_PIVOT_STREAMING, memory_budget_mb=MEMORY_BUDGET_MB, storage_mode=STOCK_STORAGE_MODE)
+
+    # Task 1, sharded mode
+    @task(task_id='plan_stock_shards')
+    def plan_shards():
+        from include.tasks.dag_tasks import plan_stock_shards
+        return plan_stock_shards(customer='22001', num_shards=NUM_STOCK_SHARDS)
+
+    @task(task_id='fetch_stock_shard')
+    def fetch_shard(shard: dict):
+        from include.tasks.dag_tasks import fetch_stock_shard
+        # Only the paths of the part of the shard go through XCom.
+        return fetch_stock_shard(customer='22001', concurrency=STOCK_API_CONCURRENCY, **shard)
+
+    @task(task_id='merge_stock_shards')
+    def merge_shards(shards: list[dict], parts: list[dict]):
+        from include.tasks.dag_tasks import merge_stock_shards
+        merge_stock_shards(customer='22001', shards=shards, parts=parts)
 
     # Task 2              
     @task(task_id='pivot_article_stock_all_stores')
     def stock_all_stores():
-        get_article_stock_all_stores(customer='22001')
+        from include.tasks.dag_tasks import get_article_stock_all_stores
+        get_article_stock_all_stores(customer='22001', streaming=STOCK_PIVOT_STREAMING, memory_budget_mb=MEMORY_BUDGET_MB, storage_mode=STOCK_STORAGE_MODE)
 
     # Task 3
     @task(task_id='get_yesterday_transaction_sales')
     def transaction_sales():
+        from include.tasks.dag_tasks import get_today_transactionSales
         get_today_transactionSales(customer='22001')
 
     # Task 4
     @task(task_id='two_days_stock_diff')
     def stock_transactions():        
+        from include.tasks.dag_tasks import stock_diff
         stock_diff(customer='22001')
 
-    stock_() >> (stock_all_stores() , transaction_sales()) >> stock_transactions()
+    # Task 5
+    @task(task_id='replenishment_candidates')
+    def replenishment_candidates():
+        from include.tasks.dag_tasks import replenishment
+        replenishment(customer='22001')
+
+    if NUM_STOCK_SHARDS:
+        shards = plan_shards()
+        stocks = merge_shards(shards, fetch_shard.expand(shard=shards))
+    else:
+        stocks = stock_()
+
+    diff = stocks >> (stock_all_stores() , transaction_sales()) >> stock_transactions()
+    replenish = diff >> replenishment_candidates()
+    if STOCK_CRAWL_DEADLINE and not NUM_STOCK_SHARDS:
+        # The follow-up pass redoes the pivot, the diff and the replenishment candidates with the completed snapshot, it must not race the first ones.
+        replenish >> complete_stocks()
 
 ETL()
@@ -0,0 +1,25 @@
+import pendulum
+local_tz = pendulum.timezone("Europe/Berlin")
+from datetime import timedelta
+from airflow.decorators import dag, task
+
+# Define default args
+default_args = {
+    'owner': 'airflow',
+    'depends_on_past': False,
+    'retries': 1,  # Number of times to retry on failure
+    'retry_delay': timedelta(minutes=5),  # Delay between retries
+}
+
+# Runs on Sunday night, outside of the window of the daily ETL DAG.
+@dag(default_args=default_args, start_date=pendulum.datetime(2025, 1, 1, tz=local_tz), schedule_interval='0 3 * * 0', catchup=False)
+def data_lake_maintenance():
+    # Compact daily files into monthly files, expire intermediate artifacts and write the manifest.
+    @task(task_id='compact_and_expire')
+    def compact_and_expire():
+        from include.tasks.dag_tasks import maintain_data_lake
+        maintain_data_lake(customer='22001')
+
+    compact_and_expire()
+
+data_lake_maintenance()
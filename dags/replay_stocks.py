@@ -0,0 +1,27 @@
+import pendulum
+local_tz = pendulum.timezone("Europe/Berlin")
+from datetime import timedelta
+from airflow.decorators import dag, task
+
+# Define default args
+default_args = {
+    'owner': 'airflow',
+    'depends_on_past': False,
+    'retries': 0,  # A failed replay reports the failed days, it is triggered again for these days by hand.
+    'retry_delay': timedelta(minutes=5),
+}
+
+# Triggered by hand, e.g. after a fix of the pivot or the diff logic:
+    # airflow dags trigger replay_stocks --conf '{"first_date": "2025-06-01", "last_date": "2025-06-30"}'
+@dag(default_args=default_args, start_date=pendulum.datetime(2025, 1, 1, tz=local_tz), schedule_interval=None, catchup=False,
+     params={"first_date": "", "last_date": "", "storage_mode": "wide"})
+def replay_stocks():
+    # Recompute the pivots and the daily stock changes of a range of days from the stored stock snapshots, without calling the API.
+    @task(task_id='replay_pivots_and_diffs')
+    def replay_pivots_and_diffs(params: dict | None = None):
+        from include.tasks.dag_tasks import replay_stocks
+        replay_stocks(customer='22001', first_date=params["first_date"], last_date=params["last_date"], storage_mode=params["storage_mode"])
+
+    replay_pivots_and_diffs()
+
+replay_stocks()
@@ -0,0 +1,169 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from datetime import date, datetime
+from pathlib import Path
+
+import polars as pl
+
+
+class stock_change_feed:
+    """Append-only log of the daily stock changes with increasing offsets.
+        Every append writes one Arrow IPC segment, the index of the segments is only updated after the segment is written,
+        so readers never see a partly written segment. Consumers pull the records since an offset instead of reloading daily files.
+        A day that is published again (re-run, replay, completion of a crawl with deadline) gets a replacement segment at the end of the log,
+        its earlier segments are marked as superseded in the index and are not read anymore. The records of the replacement carry the revision of the day.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        root (Path): Folder of the segments, the index and the consumer offsets.
+    Methods:
+        append(changes, day, previous_day): Appends the changes between two days, returns the offsets of the new records.
+        read(offset, max_records): Returns the records from an offset on.
+        next_offset(): Returns the offset of the next record that will be appended.
+    """
+    schema = {"offset": pl.Int64, "articleId": pl.Int64, "branch": pl.String, "size": pl.Int32, "old": pl.Int32, "new": pl.Int32,
+              "day": pl.Date, "previous_day": pl.Date, "revision": pl.Int32}
+    index_schema = {"segment": pl.String, "first_offset": pl.Int64, "last_offset": pl.Int64, "day": pl.Date, "previous_day": pl.Date,
+                    "n_records": pl.Int64, "created": pl.Datetime, "revision": pl.Int32, "superseded": pl.Boolean}
+
+    def __init__(self, customer: str = '22001'):
+        self.customer = customer
+        self.root = Path(f"/usr/local/airflow/include/data/{customer}/change_feed")
+        self.index_path = self.root.joinpath("index.parquet")
+
+    @contextmanager
+    def _lock(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root.joinpath("feed.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def index(self) -> pl.DataFrame:
+        if not self.index_path.is_file():
+            return pl.DataFrame(schema=self.index_schema)
+        index = pl.read_parquet(self.index_path)
+        # Indexes written before days could be replaced.
+        if "superseded" not in index.columns:
+            index = index.with_columns(pl.lit(0, dtype=pl.Int32).alias("revision"), pl.lit(False).alias("superseded"))
+        return index
+
+    def next_offset(self) -> int:
+        index = self.index()
+        return 0 if index.is_empty() else index["last_offset"].max() + 1
+
+    def append(self, changes: pl.DataFrame, day: date, previous_day: date) -> tuple[int, int] | None:
+        """Appends the stock changes between two days, the segments of an earlier publication of the day are superseded.
+        Args:
+            changes (pl.DataFrame): The saved result of stocksDatabase.two_daily_stock_changes() with the columns articleId, branch, size, pre_amount and curr_amount.
+            day (date): The current day.
+            previous_day (date): The day compared with.
+        Returns:
+            tuple[int, int] | None: The first and the last offset of the appended records, None if nothing was appended.
+        """
+        with self._lock():
+            index = self.index()
+            published = index.filter(pl.col("day") == day, ~pl.col("superseded"))
+            if changes.is_empty() and published.is_empty():
+                return None
+            # A republished day without changes still gets an empty replacement segment, its earlier records are not valid anymore.
+            revision = 0 if published.is_empty() else published["revision"].max() + 1
+
+            first_offset = self.next_offset()
+            records = (changes.select(pl.col("articleId"), pl.col("branch").cast(pl.String), pl.col("size"),
+                                      pl.col("pre_amount").alias("old"), pl.col("curr_amount").alias("new"))
+                              .sort(["articleId", "size", "branch"])
+                              .with_row_index("offset", offset=first_offset)
+                              .with_columns(pl.lit(day).alias("day"), pl.lit(previous_day).alias("previous_day"), pl.lit(revision).alias("revision"))
+                              .cast(self.schema)
+                       if not changes.is_empty() else pl.DataFrame(schema=self.schema))
+            last_offset = first_offset + records.height - 1
+
+            # An empty segment takes no offset, the next segment starts at the same offset. The day keeps their names apart.
+            segment = self.root.joinpath(f"segment_{first_offset:020d}_{day.strftime('%Y%m%d')}_r{revision}.arrow")
+            tmp = segment.with_suffix(".tmp")
+            records.write_ipc(tmp, compression="uncompressed")
+            os.replace(tmp, segment)
+
+            # The index is the commit point of the append and of the replacement.
+            entry = pl.DataFrame([{"segment": segment.name, "first_offset": first_offset, "last_offset": last_offset, "day": day,
+                                   "previous_day": previous_day, "n_records": records.height, "created": datetime.now(),
+                                   "revision": revision, "superseded": False}], schema=self.index_schema)
+            index = index.with_columns((pl.col("superseded") | (pl.col("day") == day)).alias("superseded"))
+            tmp = self.index_path.with_suffix(".tmp")
+            pl.concat([index, entry], how="diagonal_relaxed").write_parquet(tmp)
+            os.replace(tmp, self.index_path)
+        if revision:
+            print(f"\033[33m{published['n_records'].sum()} earlier stock changes of {day} superseded by revision {revision}\033[0m")
+        print(f"\033[32m{records.height} stock changes of {day} appended to the change feed, offsets {first_offset} to {last_offset}\033[0m")
+        return first_offset, last_offset
+
+    def read(self, offset: int = 0, max_records: int | None = None) -> pl.DataFrame:
+        """Returns the records from an offset on, only the segments that contain them are read (memory-mapped), superseded segments are skipped.
+        Args:
+            offset (int, optional): The first offset to return. Defaults to 0.
+            max_records (int, optional): The maximum number of records. Defaults to all records.
+        Returns:
+            pl.DataFrame: The records sorted by offset.
+        """
+        segments = self.index().filter(pl.col("last_offset") >= offset, ~pl.col("superseded")).sort("first_offset")
+        if max_records is not None:
+            # Segments starting after the last requested offset are not needed.
+            segments = segments.filter(pl.col("first_offset") < offset + max_records)
+        if segments.is_empty():
+            return pl.DataFrame(schema=self.schema)
+        # Segments written before days could be replaced have no revision column.
+        records = (pl.concat([pl.scan_ipc(self.root.joinpath(segment)) for segment in segments["segment"]], how="diagonal_relaxed")
+                        .filter(pl.col("offset") >= offset))
+        if "revision" not in records.collect_schema().names():
+            records = records.with_columns(pl.lit(0, dtype=pl.Int32).alias("revision"))
+        records = records.with_columns(pl.col("revision").fill_null(0))
+        if max_records is not None:
+            records = records.head(max_records)
+        return records.collect()
+
+
+class change_feed_consumer:
+    """A named consumer of the stock change feed that resumes from its stored offset.
+        Records with revision > 0 replace the records of their day a consumer may already have processed.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        name (str): Name of the consumer, e.g. 'replenishment'.
+    Methods:
+        poll(max_records): Returns the records after the committed offset.
+        commit(records): Stores the offset after the last of the records as new offset of the consumer.
+    """
+    def __init__(self, customer: str = '22001', name: str = 'default'):
+        self.feed = stock_change_feed(customer)
+        self.name = name
+        self.offsets_path = self.feed.root.joinpath("consumers.parquet")
+
+    @property
+    def offset(self) -> int:
+        if not self.offsets_path.is_file():
+            return 0
+        offsets = pl.read_parquet(self.offsets_path).filter(pl.col("consumer") == self.name)
+        return 0 if offsets.is_empty() else offsets["offset"].item()
+
+    def poll(self, max_records: int | None = None) -> pl.DataFrame:
+        records = self.feed.read(self.offset, max_records=max_records)
+        print(f"\033[32m{records.height} stock changes polled by {self.name} from offset {self.offset}\033[0m")
+        return records
+
+    def commit(self, records: pl.DataFrame) -> None:
+        """Stores the offset after the last record as new offset, call it once the records are processed.
+        Args:
+            records (pl.DataFrame): The records returned by poll().
+        Returns:
+            None
+        """
+        if records.is_empty():
+            return
+        with self.feed._lock():
+            offsets = pl.read_parquet(self.offsets_path) if self.offsets_path.is_file() else pl.DataFrame(schema={"consumer": pl.String, "offset": pl.Int64, "updated": pl.Datetime})
+            entry = pl.DataFrame([{"consumer": self.name, "offset": records["offset"].max() + 1, "updated": datetime.now()}], schema=offsets.schema)
+            tmp = self.offsets_path.with_suffix(".tmp")
+            pl.concat([offsets.filter(pl.col("consumer") != self.name), entry]).write_parquet(tmp)
+            os.replace(tmp, self.offsets_path)
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class aimd_controller:
+    """Adaptive limit for the number of in-flight requests to a remote API (additive increase, multiplicative decrease).
+        After every window of finished requests the limit is raised by additive_increase if the latency percentile and the error rate are healthy,
+        otherwise it is multiplied by decrease_factor. A 429 answer of the API lowers the limit immediately, but only once per burst:
+        429 answers of requests that were started before the last decrease were sent under the old limit and are ignored.
+    Attributes:
+        initial_limit (int): Number of in-flight requests at the start. default is 4.
+        min_limit (int): Lower bound of the limit. default is 1.
+        max_limit (int): Upper bound of the limit, also the size of the worker pool. default is 32.
+        additive_increase (float): Value added to the limit after a healthy window. default is 1.
+        decrease_factor (float): Factor applied to the limit after an unhealthy window. default is 0.5.
+        latency_target (float): Latency in seconds the latency percentile must stay under. default is 2.0.
+        latency_percentile (float): Percentile of the window latencies compared with latency_target. default is 95.
+        max_error_rate (float): Share of 429/5xx/transport errors tolerated in a window. default is 0.05.
+        window (int): Number of finished requests between two adjustments. default is 20.
+    Methods:
+        acquire(): Blocks until a request slot is free.
+        release(latency, status_code): Frees the slot and records the outcome of the request.
+        limit: The current limit of in-flight requests.
+    """
+    def __init__(self, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 32, additive_increase: float = 1, decrease_factor: float = 0.5,
+                 latency_target: float = 2.0, latency_percentile: float = 95, max_error_rate: float = 0.05, window: int = 20):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError(f"\033[31mThe concurrency limits must satisfy 1 <= min_limit <= initial_limit <= max_limit, got {min_limit}, {initial_limit}, {max_limit}\033[0m")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.latency_percentile = latency_percentile
+        self.max_error_rate = max_error_rate
+        self.window = window
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._latencies = deque(maxlen=window)
+        self._errors = deque(maxlen=window)
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def __repr__(self):
+        return f"aimd_controller(limit={self.limit}, in_flight={self._in_flight}, min_limit={self.min_limit}, max_limit={self.max_limit})"
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency: float, status_code: int | None = 200) -> None:
+        """Frees a request slot and adjusts the limit.
+        Args:
+            latency (float): Duration of the request in seconds.
+            status_code (int | None, optional): HTTP status of the answer, None if no answer was received (timeout, connection error). Defaults to 200.
+        Returns:
+            None
+        """
+        with self._condition:
+            self._in_flight -= 1
+            is_error = status_code is None or status_code == 429 or status_code >= 500
+            self._latencies.append(latency)
+            self._errors.append(is_error)
+
+            if status_code == 429:
+                # The API is explicitly throttling, back off without waiting for the window to fill up.
+                    # The requests in flight during the decrease answer 429 as well, they must not halve the limit again.
+                if time.time() - latency >= self._last_decrease:
+                    self._decrease()
+            elif len(self._latencies) >= self.window:
+                error_rate = sum(self._errors) / len(self._errors)
+                latency_p = np.percentile(self._latencies, self.latency_percentile)
+                if error_rate > self.max_error_rate or latency_p > self.latency_target:
+                    self._decrease()
+                else:
+                    self._limit = min(self.max_limit, self._limit + self.additive_increase)
+                    self._latencies.clear()
+                    self._errors.clear()
+            self._condition.notify_all()
+
+    def _decrease(self) -> None:
+        self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+        self._last_decrease = time.time()
+        self._latencies.clear()
+        self._errors.clear()
+        print(f"\033[33mAPI is congested, lowering the number of in-flight requests to {self.limit}\033[0m")
@@ -0,0 +1,74 @@
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from include.change_feed import stock_change_feed
+from include.sales import read_sales
+
+# New articles are not in the previous snapshot and cannot be carried forward, they rank above any sales/volatility score (at most 1.5).
+DEFAULT_WEIGHTS = {"new": 2.0, "sales": 1.0, "volatility": 0.5}
+
+
+def article_priorities(customer: str, articles: np.ndarray, run_date: date, previous_snapshot: str | None = None,
+                       lookback_days: int = 7, weights: dict | None = None) -> pl.DataFrame:
+    """Ranks the articles of a stock crawl by importance, the most important articles are fetched first.
+    Args:
+        customer (str): Customer identifier.
+        articles (np.ndarray): The article IDs to fetch.
+        run_date (date): The day of the crawl, sales and stock changes of the lookback_days days before it are used.
+        previous_snapshot (str, optional): The previous stock snapshot, articles missing in it are new. Defaults to None (no article is new).
+        lookback_days (int, optional): Number of days of sales and stock changes. Defaults to 7.
+        weights (dict, optional): Weights of the keys 'new', 'sales' and 'volatility'. Defaults to DEFAULT_WEIGHTS.
+    Returns:
+        pl.DataFrame: The columns articleId, recent_sales, n_changes, is_new and priority, sorted by priority (highest first).
+    """
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    since = run_date - timedelta(days=lookback_days)
+
+    # Recent sales, days without sales file (weekends, holidays) are skipped.
+    frames = []
+    for i in range(1, lookback_days + 1):
+        try:
+            frames.append(read_sales(customer, run_date - timedelta(days=i)).select("custArtId", "num_daily_sales"))
+        except FileNotFoundError:
+            continue
+    if frames:
+        sales = (pl.concat(frames)
+                        .group_by("custArtId")
+                        .agg(pl.col("num_daily_sales").sum().alias("recent_sales"))
+                        .select(pl.col("custArtId").cast(pl.Int64).alias("articleId"), pl.col("recent_sales").cast(pl.Float64))
+                        .collect())
+    else:
+        sales = pl.DataFrame(schema={"articleId": pl.Int64, "recent_sales": pl.Float64})
+
+    # Stock volatility: number of changed stock rows in the change feed.
+    feed = stock_change_feed(customer)
+    segments = feed.index().filter(pl.col("day") > since)
+    if not segments.is_empty():
+        volatility = (feed.read(offset=segments["first_offset"].min())
+                            .filter(pl.col("day") > since)
+                            .group_by("articleId")
+                            .agg(pl.len().cast(pl.Float64).alias("n_changes")))
+    else:
+        volatility = pl.DataFrame(schema={"articleId": pl.Int64, "n_changes": pl.Float64})
+
+    priorities = (pl.DataFrame({"articleId": articles}).cast({"articleId": pl.Int64})
+                        .join(sales, on="articleId", how="left")
+                        .join(volatility, on="articleId", how="left")
+                        .fill_null(0))
+
+    if previous_snapshot is not None and Path(previous_snapshot).is_file():
+        known = pl.scan_parquet(previous_snapshot).select(pl.col("articleId").cast(pl.Int64).unique()).collect()
+        priorities = priorities.with_columns(pl.col("articleId").is_in(known["articleId"]).not_().alias("is_new"))
+    else:
+        priorities = priorities.with_columns(pl.lit(False).alias("is_new"))
+
+    priorities = (priorities.with_columns((weights["new"] * pl.col("is_new").cast(pl.Float64)
+                                           + weights["sales"] * (pl.col("recent_sales") / pl.col("recent_sales").max()).fill_nan(0)
+                                           + weights["volatility"] * (pl.col("n_changes") / pl.col("n_changes").max()).fill_nan(0)).alias("priority"))
+                            .sort(["priority", "articleId"], descending=[True, False]))
+    print(f"\033[32mArticles ranked for the crawl: {priorities['is_new'].sum()} new, {(priorities['recent_sales'] > 0).sum()} sold and "
+          f"{(priorities['n_changes'] > 0).sum()} with stock changes in the last {lookback_days} days\033[0m")
+    return priorities
@@ -0,0 +1,174 @@
+import os
+import re
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import polars as pl
+
+from include.sales import read_sales
+from plugins.g_utils import ARTIFACT_FILE, artifact_files, resolve_artifact
+
+
+class data_lake_maintenance:
+    """Compaction and retention of the files the DAG writes under include/data/{customer}.
+        Daily files of months that are out of the retention window of the daily tasks are merged into one monthly file per kind,
+        intermediate artifacts (wide pivots, store matrices, stock cubes, pending articles, Arrow IPC hand-off files) are expired after a number of days and a manifest of all files is kept.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        keep_daily_days (int): Daily files younger than this are never compacted, the daily tasks still read them. default is 35.
+        expire_after_days (dict): Number of days after which intermediate artifacts matching a file pattern are deleted.
+        row_group_size (int): Number of rows per row group in the monthly files. default is 500_000.
+    Methods:
+        run(): Compacts, expires and writes the manifest.
+        compact_month(root_name, year, month): Merges the daily files of a month into monthly files.
+        expire(): Deletes expired intermediate artifacts.
+        write_manifest(): Writes the list of all files of the customer.
+    """
+    # pattern of the daily artifact (the file name without version and suffix) -> name of the monthly file, {ym} is replaced by YYYYMM.
+    compaction_rules = {
+        "stocks": {r"^\d{8}$": "stocks_{ym}.parquet",
+                   r"^dailyStockChanges_\d{8}_vs_\d{8}$": "dailyStockChanges_{ym}.parquet",
+                   r"^replenishmentCandidates_\d{8}$": "replenishmentCandidates_{ym}.parquet",
+                   # Reports of the crawl and of the stock checks, one row per pass or run and the quarantined rows.
+                   r"^coverage_\d{8}$": "coverage_{ym}.parquet",
+                   r"^validation_\d{8}$": "validation_{ym}.parquet",
+                   r"^quarantine_\d{8}$": "quarantine_{ym}.parquet"},
+        "articles": {r"^article_\d{8}$": "articles_{ym}.parquet",
+                     r"^number_of_articles$": "number_of_articles_{ym}.parquet"},
+    }
+
+    def __init__(self, customer: str = '22001', keep_daily_days: int = 35, expire_after_days: dict | None = None, row_group_size: int = 500_000):
+        self.customer = customer
+        self.root = Path(f"/usr/local/airflow/include/data/{customer}")
+        self.keep_daily_days = keep_daily_days
+        # The diff task looks up to 20 days back for the previous pivot, wide pivots and store matrices must outlive that.
+        # The published files carry a version, {artifact}.{version}.parquet.
+        self.expire_after_days = expire_after_days or {r"^pivotArtStoresStock_\d{8}(\.v\d+p\d+)?\.parquet$": 30,
+                                                       r"^pivotArtStoresStock_\d{8}(\.v\d+p\d+)?\.index\.parquet$": 30,
+                                                       r"^pivotMatrix_\d{8}(\.v\d+p\d+)?\.parquet$": 30,
+                                                       r"^pivotMatrix_\d{8}(\.v\d+p\d+)?\.index\.parquet$": 30,
+                                                       r"^stockCube_\d{8}\.npy$": 30,
+                                                       # Articles left for a follow-up pass which never ran, the next snapshot has fetched them again.
+                                                       r"^pending_\d{8}\.parquet$": 7,
+                                                       r"\.arrow$": 7}
+        self.row_group_size = row_group_size
+
+    def _day_folders(self, root_name: str):
+        """Yields (date, folder) for every day folder under include/data/{customer}/{root_name}/year/month/day."""
+        for day_folder in sorted(self.root.glob(f"{root_name}/*/*/*")):
+            if not day_folder.is_dir():
+                continue
+            try:
+                day = datetime.strptime(f"{day_folder.parent.parent.name} {day_folder.parent.name} {day_folder.name}", "%Y %B %d").date()
+            except ValueError:
+                continue
+            yield day, day_folder
+
+    def _write_monthly(self, frames: list[pl.LazyFrame], target: Path, sort_by: list[str] | None = None) -> None:
+        # Files already compacted in an earlier run are merged again, so a month can be compacted in several steps.
+        if target.is_file():
+            frames = [pl.scan_parquet(target)] + frames
+        lf = pl.concat(frames, how="diagonal_relaxed")
+        if sort_by:
+            lf = lf.sort(sort_by)
+        tmp = target.with_suffix(".tmp")
+        lf.sink_parquet(tmp, row_group_size=self.row_group_size)
+        os.replace(tmp, target)
+
+    def compact_month(self, root_name: str, year: int, month: int) -> None:
+        """Merges the daily files of a month into one monthly file per kind and deletes the daily files afterwards.
+        Args:
+            root_name (str): One of 'stocks', 'articles' or 'sales'.
+            year (int): The year of the month.
+            month (int): The month number.
+        Returns:
+            None
+        """
+        days = [(day, folder) for day, folder in self._day_folders(root_name) if (day.year, day.month) == (year, month)]
+        if not days:
+            return
+        month_folder = days[0][1].parent
+        ym = f"{year}{month:02d}"
+
+        if root_name == "sales":
+            # The day folders hold either one sales file or one folder per custStoreId, read_sales() handles both.
+            frames, sources = [], []
+            for day, folder in days:
+                files = [f for f in folder.rglob("*.parquet")]
+                if files:
+                    frames.append(read_sales(self.customer, day).with_columns(pl.lit(day).alias("snapshot_date")))
+                    sources.extend(files)
+            if frames:
+                self._write_monthly(frames, month_folder.joinpath(f"sales_{ym}.parquet"), sort_by=["custStoreId", "snapshot_date"])
+                self._remove(sources)
+                print(f"\033[32m{len(sources)} daily sales files of {ym} compacted into {month_folder}/sales_{ym}.parquet\033[0m")
+        else:
+            for pattern, target_name in self.compaction_rules[root_name].items():
+                frames, sources = [], []
+                for day, folder in days:
+                    artifacts = {match["artifact"] for match in map(ARTIFACT_FILE.match, (file.name for file in folder.iterdir())) if match}
+                    for artifact in sorted(artifacts):
+                        source = resolve_artifact(folder, artifact, ipc=False) if re.search(pattern, artifact) else None
+                        if source is not None:
+                            # Only the published version is compacted, all versions and the Arrow IPC copies are removed.
+                            frames.append(pl.scan_parquet(source).with_columns(pl.lit(day).alias("snapshot_date")))
+                            sources.extend(artifact_files(folder, artifact))
+                if frames:
+                    target_name = target_name.format(ym=ym)
+                    self._write_monthly(frames, month_folder.joinpath(target_name))
+                    self._remove(sources)
+                    print(f"\033[32m{len(sources)} daily files of {ym} compacted into {month_folder}/{target_name}\033[0m")
+
+        # Remove day folders which are empty now, the publish manifest only points to the files which have been compacted and the lock files are not needed anymore.
+        for _, folder in days:
+            if all(file.name == "publish_manifest.parquet" or file.suffix == ".lock" for file in folder.iterdir()):
+                self._remove(list(folder.iterdir()))
+            for sub_folder in sorted(folder.rglob("*"), reverse=True):
+                if sub_folder.is_dir() and not any(sub_folder.iterdir()):
+                    sub_folder.rmdir()
+            if not any(folder.iterdir()):
+                folder.rmdir()
+
+    @staticmethod
+    def _remove(files: list[Path]) -> None:
+        for file in files:
+            file.unlink(missing_ok=True)
+
+    def expire(self) -> None:
+        today = date.today()
+        n_removed = 0
+        for root_name in ("stocks", "articles", "sales"):
+            for day, folder in self._day_folders(root_name):
+                for file in folder.iterdir():
+                    for pattern, days in self.expire_after_days.items():
+                        if re.search(pattern, file.name) and (today - day).days > days:
+                            file.unlink(missing_ok=True)
+                            n_removed += 1
+                            break
+        print(f"\033[32m{n_removed} expired intermediate artifacts deleted for customer {self.customer}\033[0m")
+
+    def write_manifest(self) -> pl.DataFrame:
+        rows = []
+        for file in self.root.rglob("*"):
+            if file.is_file() and file.name != "manifest.parquet":
+                stat = file.stat()
+                rows.append({"path": str(file.relative_to(self.root)),
+                             "kind": file.parts[len(self.root.parts)] if file.parent != self.root else "root",
+                             "size_bytes": stat.st_size,
+                             "modified": datetime.fromtimestamp(stat.st_mtime)})
+        manifest = pl.DataFrame(rows, schema={"path": pl.String, "kind": pl.String, "size_bytes": pl.Int64, "modified": pl.Datetime}).sort("path")
+        manifest.write_parquet(self.root.joinpath("manifest.parquet"))
+        print(f"\033[32mManifest of {manifest.height} files ({manifest['size_bytes'].sum() / 1024 ** 3:.2f} GB) saved on {self.root}/manifest.parquet\033[0m")
+        return manifest
+
+    def run(self) -> pl.DataFrame:
+        cutoff = date.today() - timedelta(days=self.keep_daily_days)
+        for root_name in ("stocks", "articles", "sales"):
+            # Only months whose last day is older than the cutoff are compacted.
+            months = sorted({(day.year, day.month) for day, _ in self._day_folders(root_name)})
+            for year, month in months:
+                last_day = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1))
+                if last_day < cutoff:
+                    self.compact_month(root_name, year, month)
+        self.expire()
+        return self.write_manifest()
@@ -0,0 +1,72 @@
+import resource
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+
+def peak_memory_mb() -> float:
+    """Peak resident memory of the current process in MB (ru_maxrss is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_memory_mb() -> float:
+    """Current resident memory of the current process in MB, the peak memory where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return peak_memory_mb()
+
+
+class spill_buffer:
+    """Collects DataFrames in memory up to a memory budget and spills them to parquet parts once the budget is approached.
+    Attributes:
+        spill_path (Path): Folder of the spilled parts, it is removed by cleanup().
+        budget_mb (float): Memory budget in MB.
+        high_watermark (float): Share of the budget the buffered frames may take before they are spilled. default is 0.5,
+            the other half is left for the batch that is being processed and the final write.
+    Methods:
+        add(df): Adds a DataFrame, spills the buffer if the budget is approached.
+        to_lazy(): Returns one LazyFrame over the spilled parts and the frames still in memory.
+        cleanup(): Removes the spilled parts.
+    """
+    def __init__(self, spill_path, budget_mb: float, high_watermark: float = 0.5):
+        self.spill_path = Path(spill_path)
+        self.budget_mb = budget_mb
+        self.high_watermark = high_watermark
+        self._frames = []
+        self._buffered_bytes = 0
+        self._parts = []
+
+        if self.spill_path.exists():
+            shutil.rmtree(self.spill_path)
+
+    def add(self, df: pl.DataFrame) -> None:
+        if df.is_empty():
+            return
+        self._frames.append(df)
+        self._buffered_bytes += df.estimated_size()
+        if self._buffered_bytes > self.budget_mb * 1024 ** 2 * self.high_watermark:
+            self._spill()
+
+    def _spill(self) -> None:
+        self.spill_path.mkdir(parents=True, exist_ok=True)
+        part = self.spill_path.joinpath(f"part_{len(self._parts):05d}.parquet")
+        pl.concat(self._frames, how="diagonal_relaxed").write_parquet(part)
+        print(f"\033[33mMemory budget of {self.budget_mb} MB approached, {self._buffered_bytes / 1024 ** 2:.1f} MB spilled to {part}\033[0m")
+        self._parts.append(part)
+        self._frames = []
+        self._buffered_bytes = 0
+
+    def to_lazy(self) -> pl.LazyFrame:
+        frames = [pl.scan_parquet(part) for part in self._parts] + [df.lazy() for df in self._frames]
+        if not frames:
+            return pl.LazyFrame()
+        return pl.concat(frames, how="diagonal_relaxed")
+
+    def cleanup(self) -> None:
+        if self.spill_path.exists():
+            shutil.rmtree(self.spill_path)
+        self._frames = []
+        self._parts = []
@@ -0,0 +1,79 @@
+import os
+from datetime import date, timedelta
+
+from joblib import Parallel, delayed
+
+from include.change_feed import stock_change_feed
+from include.stocks import stocksDatabase
+from plugins.g_utils import get_previous_working_day, resolve_pivot, stock_snapshot_exists
+
+
+def _replay_pivot(customer: str, day: date, storage_mode: str, memory_budget_mb: float | None):
+    try:
+        stocksDatabase(customerId=customer, storage_mode=storage_mode, execution_date=day).daily_stocks(streaming=True, memory_budget_mb=memory_budget_mb).save()
+    except Exception as e:
+        return day, f"{type(e).__name__}: {e}"
+    return day, None
+
+def _replay_diff(customer: str, day: date):
+    try:
+        stocks = stocksDatabase(customerId=customer, execution_date=day)
+        changes = stocks.two_daily_stock_changes()
+        changes.save()
+        # The replayed changes replace the records of the day in the change feed.
+        if stocks.a_day_before:
+            stock_change_feed(customer).append(changes.values, day=day, previous_day=stocks.a_day_before)
+    except Exception as e:
+        return day, f"{type(e).__name__}: {e}"
+    return day, None
+
+
+def replay_history(customer: str, first: date, last: date, n_jobs: int | None = None, storage_mode: str = 'wide',
+                   memory_budget_mb: float | None = None) -> dict:
+    """Recomputes the pivots and the daily stock changes of a range of days from the stored raw stock snapshots, without calling the API.
+        Every day is processed by its own worker process. All pivots are built first, the diffs need the pivot of the day before.
+    Args:
+        customer (str): Customer identifier.
+        first (date): The first day to recompute.
+        last (date): The last day to recompute, inclusive.
+        n_jobs (int, optional): Number of worker processes. Defaults to the number of cores.
+        storage_mode (str, optional): The storage mode of the pivots, 'wide' or 'normalized'. Defaults to 'wide'.
+        memory_budget_mb (float, optional): Memory budget of every worker, see stocksDatabase.daily_stocks(). Defaults to None.
+    Returns:
+        dict: The recomputed days per step, {"pivot": [...], "diff": [...]}.
+    """
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    # Weekends and holidays have no snapshot.
+    days = [day for day in days if stock_snapshot_exists(customer, day)]
+    if not days:
+        print(f"\033[33mNo stock snapshot found between {first} and {last} for the customer {customer}, nothing to replay.\033[0m")
+        return {"pivot": [], "diff": []}
+
+    # The diff of the first day compares with the working day before the range, its pivot is only rebuilt if it does not exist anymore.
+    pivot_days = list(days)
+    _, day_before, day_before_path = get_previous_working_day(customer, days[0])
+    if day_before and resolve_pivot(day_before_path, day_before)[1] is None:
+        pivot_days.insert(0, day_before)
+
+    n_jobs = min(n_jobs or os.cpu_count(), len(pivot_days))
+    # Polars uses all cores in every process by default, the workers share the cores instead of oversubscribing them.
+        # The variable is read when polars is imported, so it has to be set before the worker processes are started.
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // n_jobs))
+    print(f"\033[32mReplaying {len(days)} days from {first} to {last} with {n_jobs} workers\033[0m")
+
+    with Parallel(n_jobs=n_jobs, backend="loky") as parallel:
+        pivot_results = parallel(delayed(_replay_pivot)(customer, day, storage_mode, memory_budget_mb) for day in pivot_days)
+        failed = {day: error for day, error in pivot_results if error}
+
+        # A diff is only recomputed if the pivots of both days have been built.
+        diff_days = [day for previous, day in zip([None] + pivot_days, pivot_days) if day in days and day not in failed and previous not in failed]
+        diff_results = parallel(delayed(_replay_diff)(customer, day) for day in diff_days)
+        failed.update({day: error for day, error in diff_results if error})
+
+    if failed:
+        for day, error in sorted(failed.items()):
+            print(f"\033[31mReplay of {day} failed: {error}\033[0m")
+        raise RuntimeError(f"Replay failed for {len(failed)} of {len(days)} days between {first} and {last}: {sorted(failed)}")
+
+    print(f"\033[32m{len(pivot_days)} pivots and {len(diff_days)} daily stock changes recomputed for the customer {customer}\033[0m")
+    return {"pivot": pivot_days, "diff": diff_days}
@@ -0,0 +1,124 @@
+import hashlib
+from pathlib import Path
+
+import polars as pl
+
+
+class response_cache:
+    """On-disk cache of the stock API responses keyed by article id.
+        For every article the ETag, the Last-Modified header and a hash of the payload of the last answer are kept,
+        together with the snapshot file the answer ended up in. Unchanged articles are carried forward from that snapshot.
+    Attributes:
+        customer (str): Customer identifier.
+        path (Path): Location of the cache parquet file.
+        snapshot_path (str | None): The snapshot the cached answers are stored in, None if there is no usable cache.
+    Methods:
+        conditional_headers(article_id): Headers for a conditional request of an article.
+        is_unchanged(article_id, response): Checks an answer against the cache and records it.
+        forget(article_id): Drops the recorded answer of an article that could not be decoded.
+        carry_forward(article_ids): Reads the rows of unchanged articles from the previous snapshot.
+        save(snapshot_path, path): Persists the cache for the snapshot that has just been written.
+        to_frame(snapshot_path): Returns the recorded answers as DataFrame.
+        combine(parts): Replaces the cache by the parts of a sharded crawl.
+    """
+    schema = {"articleId": pl.Int64, "etag": pl.String, "last_modified": pl.String, "content_hash": pl.String, "snapshot_path": pl.String}
+
+    def __init__(self, customer: str = '22001'):
+        self.customer = customer
+        self.path = Path(f"/usr/local/airflow/include/data/{customer}/cache/stock_responses.parquet")
+        self.snapshot_path = None
+        self._entries = {}
+        self._updates = {}
+
+        if self.path.is_file():
+            cache_df = pl.read_parquet(self.path)
+            snapshot_paths = cache_df["snapshot_path"].unique().to_list()
+            # The cached answers are only usable as long as the snapshot they were stored in still exists.
+            if len(snapshot_paths) == 1 and Path(snapshot_paths[0]).is_file():
+                self.snapshot_path = snapshot_paths[0]
+                self._entries = {row["articleId"]: row for row in cache_df.iter_rows(named=True)}
+                print(f"\033[32mResponse cache loaded for {len(self._entries)} articles, previous snapshot: {self.snapshot_path}\033[0m")
+            else:
+                print("\033[33mWARNING the previous snapshot of the response cache does not exist anymore, fetching all articles.\033[0m")
+
+    def conditional_headers(self, article_id: int) -> dict:
+        entry = self._entries.get(int(article_id))
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def is_unchanged(self, article_id: int, response) -> bool:
+        """Checks whether the answer of the API for an article is the same as in the previous snapshot and records it.
+        Args:
+            article_id (int): The article ID.
+            response (requests.Response): The answer of the API.
+        Returns:
+            bool: True if the article can be carried forward from the previous snapshot without decoding the answer.
+        """
+        article_id = int(article_id)
+        entry = self._entries.get(article_id)
+        if response.status_code == 304 and entry is not None:
+            self._updates[article_id] = entry
+            return True
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        self._updates[article_id] = {"articleId": article_id,
+                                     "etag": response.headers.get("ETag"),
+                                     "last_modified": response.headers.get("Last-Modified"),
+                                     "content_hash": content_hash}
+        return entry is not None and entry["content_hash"] == content_hash
+
+    def forget(self, article_id: int) -> None:
+        self._updates.pop(int(article_id), None)
+
+    def carry_forward(self, article_ids: list[int]) -> pl.DataFrame:
+        """Reads the stock of unchanged articles from the previous snapshot.
+        Args:
+            article_ids (list[int]): The IDs of the unchanged articles.
+        Returns:
+            pl.DataFrame: The rows of the previous snapshot for these articles, their creDate is the one of the run that fetched them.
+        """
+        if not article_ids:
+            return pl.DataFrame()
+        carried_df = (pl.scan_parquet(self.snapshot_path)
+                                    .filter(pl.col("articleId").is_in(list(article_ids)))
+                                    .collect())
+        print(f"\033[32m{len(article_ids)} unchanged articles carried forward from {self.snapshot_path} ({carried_df.height} rows)\033[0m")
+        return carried_df
+
+    def to_frame(self, snapshot_path: str | None = None) -> pl.DataFrame:
+        """Returns the recorded answers for the snapshot that has just been written, the shards of a sharded crawl hand them to the merge task."""
+        return pl.DataFrame([{**entry, "snapshot_path": str(snapshot_path) if snapshot_path is not None else None} for entry in self._updates.values()], schema=self.schema)
+
+    def save(self, snapshot_path: str, path: Path | None = None) -> None:
+        """Persists the recorded answers for the snapshot that has just been written.
+        Args:
+            snapshot_path (str): The snapshot the recorded answers are stored in.
+            path (Path, optional): Where to save the cache. Defaults to self.path.
+        Returns:
+            None
+        """
+        path = self.path if path is None else Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.to_frame(snapshot_path).write_parquet(path)
+        print(f"\033[32mResponse cache saved for {len(self._updates)} articles on {path}\033[0m")
+
+    def combine(self, parts: list[Path | pl.DataFrame]) -> None:
+        """Replaces the cache by the parts of a sharded crawl or of the passes of a crawl with deadline.
+        Args:
+            parts (list[Path | pl.DataFrame]): Cache files or the DataFrames returned by to_frame().
+        Returns:
+            None
+        """
+        parts = [part if isinstance(part, pl.DataFrame) else pl.read_parquet(part) for part in parts
+                 if isinstance(part, pl.DataFrame) or Path(part).is_file()]
+        if not parts:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        pl.concat(parts).write_parquet(self.path)
+        print(f"\033[32mResponse cache of {len(parts)} parts combined on {self.path}\033[0m")
@@ -1,8 +1,13 @@
 
 from abc import abstractmethod
+import os
+import shutil
+from datetime import date, timedelta
+from pathlib import Path
 import polars as pl
+import pyarrow.parquet as pq
 from include.customer import customer_data
-from plugins.g_utils import check_Path_exits, get_last_two_working_days
+from plugins.g_utils import atomic_path, check_Path_exits, get_last_two_working_days
 
 
 class customer_sales(customer_data):
@@ -58,7 +63,8 @@ class salesDatabase(customer_sales):
         read_gs_database(): Connects to the gStock database.
         query(): Defines the SQL query to fetch sales data from the gStock database.
         daily_sales(): Fetches and processes daily sales data.
-        save(path): Saves the daily sales data to the specified path.
+        save(path, layout, target_file_mb): Saves the daily sales data to the specified path.
+        update_rollups(): Updates the weekly and monthly sales rollups with the day's sales.
         
     """
     def __init__(self, customerId: str = '22001'):
@@ -97,22 +103,181 @@ class salesDatabase(customer_sales):
                                 .sort(["num_daily_sales"]))
         return self
 
-    def save(self, path=None):
+    def save(self, path=None, layout: str = 'single', target_file_mb: float | None = None):
         """Saves daily sales data to a specified path.
         Args:
             path (str, optional): The path where the data will be saved. Defaults to None.
+            layout (str, optional): 'single' writes sales_YYYYMMDD.parquet into the day folder, sorted by custStoreId with one row group per store,
+                'partitioned' writes one folder per custStoreId (the old layout). Defaults to 'single'.
+            target_file_mb (float, optional): In the single layout, split the stores over several files of about this size. Defaults to None (one file).
         Returns:
             None.
         """
         if path is None:
             path = check_Path_exits(customerId=self.customerId, root_name="sales", current_year=self.a_day_before.strftime('%Y'), current_month=self.a_day_before.strftime('%B'), current_day=self.a_day_before.strftime('%d'))
-              
-        self._df.write_parquet(file=path,
-                                use_pyarrow=True,
-                                pyarrow_options={"partition_cols": ["custStoreId"]})  
-        print(f"\033[32mSaving yesterday's sales data on {path}\033[0m")
-         
+        path = Path(path)
 
+        # The files of an earlier run of the day in either layout are only removed once the new files are in place, the reader must not find both.
+        if layout == 'partitioned':
+            # The store folders are written next to the day folder and moved in one by one.
+            staging = path.parent.joinpath(f".{path.name}.sales.{os.getpid()}.tmp")
+            shutil.rmtree(staging, ignore_errors=True)
+            self._df.write_parquet(file=staging,
+                                    use_pyarrow=True,
+                                    pyarrow_options={"partition_cols": ["custStoreId"]})  
+            new_folders = {folder.name for folder in staging.iterdir()}
+            for folder in staging.iterdir():
+                target = path.joinpath(folder.name)
+                if target.exists():
+                    retired = path.parent.joinpath(f".{path.name}.{folder.name}.{os.getpid()}.old")
+                    os.replace(target, retired)
+                    os.replace(folder, target)
+                    shutil.rmtree(retired)
+                else:
+                    os.replace(folder, target)
+            staging.rmdir()
+            for old in list(path.glob("sales_*.parquet")) + [folder for folder in path.glob("custStoreId=*") if folder.name not in new_folders]:
+                shutil.rmtree(old) if old.is_dir() else old.unlink()
+            print(f"\033[32mSaving yesterday's sales data on {path}\033[0m")
+            return
 
+        df = self._df.sort(["custStoreId", "custArtId", "custSizeId"])
+        stores = df.partition_by("custStoreId", maintain_order=True)
+        # Group the stores into files of about target_file_mb.
+        files, current, current_bytes = [], [], 0
+        for store_df in stores:
+            if current and target_file_mb is not None and current_bytes + store_df.estimated_size() > target_file_mb * 1024 ** 2:
+                files.append(current)
+                current, current_bytes = [], 0
+            current.append(store_df)
+            current_bytes += store_df.estimated_size()
+        if current:
+            files.append(current)
 
-    
\ No newline at end of file
+        file_name = f"sales_{self.a_day_before.strftime('%Y%m%d')}"
+        written = set()
+        for i, file_stores in enumerate(files):
+            file_path = path.joinpath(f"{file_name}.parquet" if len(files) == 1 else f"{file_name}_{i}.parquet")
+            # One row group per store, the min/max statistics of custStoreId prune all other stores.
+            with atomic_path(file_path) as tmp:
+                with pq.ParquetWriter(tmp, schema=file_stores[0].to_arrow().schema) as writer:
+                    for store_df in file_stores:
+                        writer.write_table(store_df.to_arrow())
+            written.add(file_path.name)
+        for old in list(path.glob("custStoreId=*")) + [file for file in path.glob("sales_*.parquet") if file.name not in written]:
+            shutil.rmtree(old) if old.is_dir() else old.unlink()
+        print(f"\033[32mSaving yesterday's sales data on {path} as {len(files)} file(s) {file_name}*.parquet ({len(stores)} stores)\033[0m")
+
+    def _rollups_path(self) -> Path:
+        return Path(f"/usr/local/airflow/include/data/{self.customerId}/sales_rollups")
+
+    @staticmethod
+    def _replace_file(df: pl.DataFrame, path: Path) -> None:
+        # Write next to the target and rename, readers never see a half written rollup.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        df.write_parquet(tmp)
+        os.replace(tmp, path)
+
+    def update_rollups(self):
+        """Updates the weekly and monthly rollups per article, size and store with the day's sales.
+            The day's aggregate replaces the rows of the same bookingDate in the monthly ledger, so a re-extracted day is never counted twice.
+            Only the ISO week and the month of the day are recomputed, from the ledger instead of the daily partitions.
+        Returns:
+            self: The instance itself.
+        """
+        day = self.a_day_before
+        booking_date = int(day.strftime('%Y%m%d'))
+        rollups_path = self._rollups_path()
+
+        # Ledger of the day aggregates of the month.
+        ledger_path = rollups_path.joinpath("ledger", f"{day.strftime('%Y%m')}.parquet")
+        day_df = self._df.select(["custStoreId", "custArtId", "custSizeId", "bookingDate", "num_daily_sales"])
+        if ledger_path.is_file():
+            ledger = pl.concat([pl.read_parquet(ledger_path).filter(pl.col("bookingDate") != booking_date), day_df], how="vertical_relaxed")
+        else:
+            ledger = day_df
+        self._replace_file(ledger, ledger_path)
+
+        keys = ["custArtId", "custSizeId", "custStoreId"]
+        # Monthly rollup.
+        monthly = (ledger.group_by(keys)
+                            .agg(pl.col("num_daily_sales").sum().alias("num_sales"), pl.col("bookingDate").n_unique().alias("n_days"))
+                            .with_columns(pl.lit(day.strftime('%Y-%m')).alias("month"))
+                            .sort(keys))
+        self._replace_file(monthly, rollups_path.joinpath("monthly", f"{day.strftime('%Y-%m')}.parquet"))
+
+        # Weekly rollup, an ISO week may span two monthly ledgers.
+        iso_year, iso_week, iso_weekday = day.isocalendar()
+        monday = day - timedelta(days=iso_weekday - 1)
+        week_days = [int((monday + timedelta(days=i)).strftime('%Y%m%d')) for i in range(7)]
+        ledger_paths = {rollups_path.joinpath("ledger", f"{(monday + timedelta(days=i)).strftime('%Y%m')}.parquet") for i in range(7)}
+        week_df = pl.concat([pl.read_parquet(path) for path in ledger_paths if path.is_file()], how="vertical_relaxed").filter(pl.col("bookingDate").is_in(week_days))
+        weekly = (week_df.group_by(keys)
+                            .agg(pl.col("num_daily_sales").sum().alias("num_sales"), pl.col("bookingDate").n_unique().alias("n_days"))
+                            .with_columns(pl.lit(f"{iso_year}-W{iso_week:02d}").alias("week"))
+                            .sort(keys))
+        self._replace_file(weekly, rollups_path.joinpath("weekly", f"{iso_year}-W{iso_week:02d}.parquet"))
+        print(f"\033[32mSales rollups of week {iso_year}-W{iso_week:02d} and month {day.strftime('%Y-%m')} updated on {rollups_path}\033[0m")
+        return self
+
+
+def read_sales_rollups(customerId: str, period: str, first: date, last: date) -> pl.DataFrame:
+    """Reads the pre-aggregated sales per article, size and store of the weeks or months between two dates.
+    Args:
+        customerId (str): The ID of the customer.
+        period (str): 'week' or 'month'.
+        first (date): First date of the range.
+        last (date): Last date of the range.
+    Returns:
+        pl.DataFrame: The rollups of all weeks or months touching the range.
+    """
+    rollups_path = Path(f"/usr/local/airflow/include/data/{customerId}/sales_rollups")
+    names = set()
+    day = first
+    while day <= last:
+        if period == "week":
+            iso_year, iso_week, _ = day.isocalendar()
+            names.add(f"weekly/{iso_year}-W{iso_week:02d}.parquet")
+        elif period == "month":
+            names.add(f"monthly/{day.strftime('%Y-%m')}.parquet")
+        else:
+            raise ValueError(f"\033[31mUnknown rollup period {period}, use 'week' or 'month'\033[0m")
+        day += timedelta(days=1)
+    files = [rollups_path.joinpath(name) for name in sorted(names) if rollups_path.joinpath(name).is_file()]
+    if not files:
+        return pl.DataFrame()
+    return pl.concat([pl.read_parquet(file) for file in files], how="vertical_relaxed")
+
+
+def read_sales(customerId: str, day: date, stores: list[int] | None = None) -> pl.LazyFrame:
+    """Lazily reads the sales of a day in any of the layouts they have been saved in.
+        - single: sales_YYYYMMDD*.parquet in the day folder.
+        - partitioned: one custStoreId=... folder per store in the day folder (the old layout).
+        - compacted: sales_YYYYMM.parquet in the month folder, written by the data lake maintenance.
+    Args:
+        customerId (str): The ID of the customer.
+        day (date): The booking day.
+        stores (list[int], optional): Only read these custStoreIds. Defaults to all stores.
+    Returns:
+        pl.LazyFrame: The columns custStoreId, custArtId, custSizeId, bookingDate and num_daily_sales.
+    """
+    month_folder = Path(f"/usr/local/airflow/include/data/{customerId}/sales/{day.strftime('%Y')}/{day.strftime('%B')}")
+    day_folder = month_folder.joinpath(day.strftime('%d'))
+    columns = ["custStoreId", "custArtId", "custSizeId", "bookingDate", "num_daily_sales"]
+
+    single_files = sorted(day_folder.glob("sales_*.parquet"))
+    if single_files:
+        lf = pl.scan_parquet(single_files)
+    elif any(day_folder.glob("custStoreId=*")):
+        lf = pl.scan_parquet(f"{day_folder}/**/*.parquet", hive_partitioning=True)
+    elif month_folder.joinpath(f"sales_{day.strftime('%Y%m')}.parquet").is_file():
+        lf = (pl.scan_parquet(month_folder.joinpath(f"sales_{day.strftime('%Y%m')}.parquet"))
+                                .filter(pl.col("bookingDate") == int(day.strftime('%Y%m%d'))))
+    else:
+        raise FileNotFoundError(f"\033[31mNo sales data found for customer {customerId} on {day}\033[0m")
+
+    lf = lf.select(columns).with_columns(pl.col("custStoreId").cast(pl.Int32))
+    if stores is not None:
+        lf = lf.filter(pl.col("custStoreId").is_in(stores))
+    return lf
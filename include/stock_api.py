@@ -9,6 +9,12 @@ from datetime import date
 from joblib import Parallel, delayed 
 from sqlalchemy import create_engine 
 
+from include.concurrency import aimd_controller
+from include.response_cache import response_cache
+from include.stock_decoder import stock_decoder
+from include.memory_budget import peak_memory_mb, spill_buffer
+from include.crawl_priority import article_priorities
+from include.stock_validation import stock_validator
 from plugins.g_utils import *
  
  
@@ -16,37 +22,61 @@ class stock_api:
     """Class to fetch stock data from an external API and save it locally.
     Attributes:
         customer (str): Customer identifier.
+        concurrency (dict, optional): Settings of the aimd_controller which limits the in-flight API requests, e.g. {"initial_limit": 4, "max_limit": 32}.
+        use_cache (bool, optional): Send conditional requests and carry unchanged articles forward from the previous snapshot. default is True.
+        memory_budget_mb (float, optional): If given, the articles are fetched, decoded and written in bounded batches which are spilled to disk
+            when the budget is approached. default is None.
+        deadline (str, optional): Wall-clock time 'HH:MM' of the day of the run. If given, the articles are fetched by priority (recent sales,
+            stock changes, new articles) and a partial snapshot is published at the deadline, the rest is fetched by complete_pending(). default is None.
     Methods:
         get_stockes_from_api(): Fetches stock data from the API and saves it as a parquet file.
-        _connect_to_api(params: dict): Helper method to fetch stock data for given parameters.
+        complete_pending(current_timestamp): Fetches the articles left over at the deadline and completes the snapshot.
+        plan_shards(num_shards): Fetches the article list and splits the crawl into shards.
+        fetch_shard(shard, num_shards, current_timestamp): Fetches the articles of one shard, writes its part and returns the paths.
+        merge_shards(parts, num_shards, current_timestamp): Assembles the snapshot from the parts of all shards.
+        _connect_to_api(params: dict): Helper method to fetch the raw stock answer for given parameters.
         _procedure(batched_articles): Batches the data to be processed later in the get_stockes_from_api method.
         _fetch_articles_from_globalStock(): Fetches article IDs from the globalStock database.
         _save_execution_date(current_timestamp, current_year, current_month, current_day): it Saves the execution date of DAG each time it runs.
 
     """
-    def __init__(self, customer: str = '22001'):
+    # Seconds a request may take, shortened to the time left before the deadline.
+    request_timeout = 30.0
+
+    def __init__(self, customer: str = '22001', concurrency: dict | None = None, use_cache: bool = True, memory_budget_mb: float | None = None,
+                 deadline: str | None = None):
         self.customer = customer
+        self.memory_budget_mb = memory_budget_mb
+        self.controller = aimd_controller(**(concurrency or {}))
+        self.cache = response_cache(customer=customer) if use_cache else None
+        self.validator = stock_validator(customer=customer)
+        self.deadline = datetime.combine(date.today(), datetime.strptime(deadline, '%H:%M').time()).timestamp() if deadline else None
+        # Articles which have not been fetched when the deadline was hit.
+        self.pending = []
 
     def _save_execution_date(self, current_timestamp: pl.Datetime, current_year: str, current_month: str, current_day: str) -> None:        
 
         last_20_executions_date_path =f"/usr/local/airflow/include/data/{self.customer}/last_20_executions_date.parquet"
 
-        if Path(last_20_executions_date_path).is_file():
-            last_20_executions_date = pl.scan_parquet(Path(last_20_executions_date_path)).collect().tail(20)
-
-        else:
-            last_20_executions_date = pl.DataFrame()
         current_execution_date_df = pl.DataFrame(data=[[self.customer, current_year, current_month, current_day, current_timestamp]], orient="row", schema=[("customerId", pl.String), 
                                                                                                                                                 ("execution_year", pl.String), 
                                                                                                                                                 ("execution_month", pl.String),                                                                                            
                                                                                                                                                 ("execution_day", pl.String),
                                                                                                                                                 ("execution_timestamp", pl.Datetime)])
-                
-        (pl.concat([last_20_executions_date, current_execution_date_df])
-                                            .group_by("customerId", "execution_year", "execution_month", "execution_day")
-                                            .agg(pl.col("execution_timestamp").max())
-                                            .sort("execution_timestamp")
-                                            .write_parquet(last_20_executions_date_path))
+        # Overlapping runs update the file one after the other, readers see either the old or the new file.
+        with folder_lock(Path(last_20_executions_date_path).parent, "last_20_executions_date.lock"):
+            if Path(last_20_executions_date_path).is_file():
+                last_20_executions_date = pl.scan_parquet(Path(last_20_executions_date_path)).collect().tail(20)
+
+            else:
+                last_20_executions_date = pl.DataFrame()
+
+            with atomic_path(last_20_executions_date_path) as tmp:
+                (pl.concat([last_20_executions_date, current_execution_date_df])
+                                                    .group_by("customerId", "execution_year", "execution_month", "execution_day")
+                                                    .agg(pl.col("execution_timestamp").max())
+                                                    .sort("execution_timestamp")
+                                                    .write_parquet(tmp))
         
         print(f"\033[32mSaving current execution time on {current_timestamp}, year: {current_year}, month: {current_month}, day: {current_day} at last_20_executions_date_path\033[0m")
         print(f"\033[32mLast 20 Executions data: {last_20_executions_date.height}\033[0m")
@@ -64,49 +94,75 @@ class stock_api:
             "Authorization": f"BASIC {api_token}",
             "Content-Type": "application/json"
         }
-        # Send the GET request with the headers and parameters
-        response = requests.get(api_url, headers=headers, params=params)
+        if self.cache is not None:
+            # Ask the API to answer with 304 if the article has not changed since the previous snapshot.
+            headers.update(self.cache.conditional_headers(params["id"]))
+        # Send the GET request with the headers and parameters, a hanging request must not run past the deadline.
+        timeout = self.request_timeout
+        if self.deadline is not None:
+            timeout = max(1.0, min(timeout, self.deadline - time.time()))
+        response = requests.get(api_url, headers=headers, params=params, timeout=timeout)
         
         # Check for HTTP errors (e.g., 401 Unauthorized, 404 Not Found)
         response.raise_for_status()
-        # The request was successful, parse the JSON data
-        json_data = response.json()        
-        
-        # Process the data     
-        df = pl.DataFrame(json_data[0])
-        return df
+        # None means the article has not changed, its rows are carried forward from the previous snapshot without decoding.
+        if self.cache is not None and self.cache.is_unchanged(params["id"], response):
+            return None
+        # The request was successful, the raw JSON bytes are decoded by the stock_decoder of the calling batch.
+        return response.content
 
     def _procedure(self, batched_articles):
         start = time.time()
         pid = os.getpid() 
-        time.sleep(1)
         skipped_articles = []
-        df = pl.DataFrame()
+        unchanged_articles = []
+        pending_articles = []
+        # One decoder per batch, the answers are decoded into its column buffers instead of one DataFrame per article.
+        decoder = stock_decoder()
         # print(f"Processing articles: {batched_articles}")
-        for article_id in batched_articles:
+        for i, article_id in enumerate(batched_articles):
+            if self.deadline is not None and time.time() >= self.deadline:
+                # The rest of the batch has a lower priority, it is fetched by the follow-up pass.
+                pending_articles.extend(batched_articles[i:])
+                break
             params = {
                     "id": article_id,    
                 }
+            # Wait for a free request slot, the controller decides how many requests may be in flight.
+            self.controller.acquire()
+            request_start = time.time()
+            status_code = 200
             try:
-                fetched_df = self._connect_to_api(params=params)
-                df = pl.concat([df, fetched_df])
+                content = self._connect_to_api(params=params)
+                if content is None:
+                    unchanged_articles.append(article_id)
+                    continue
+                decoder.append(content)
             except requests.exceptions.RequestException as e:
+                status_code = e.response.status_code if e.response is not None else None
                 print(f"\033[31mAn Error has been occurred during fettching of the article_id {article_id}: {e}\033[0m")
                 skipped_articles.append(article_id)
                 continue   
 
             except Exception as e:
+                # Not a successful answer, the controller must not count it as one.
+                status_code = None
                 print(f"\033[31mAn unexpected has been occurred during fettching of the article_id {article_id}: {e}. Skipping.\033[0m")
+                if self.cache is not None:
+                    # The answer could not be decoded, it must not be treated as unchanged in the next run.
+                    self.cache.forget(article_id)
                 continue       
+            finally:
+                self.controller.release(latency=time.time() - request_start, status_code=status_code)
 
         end = time.time()
         exec_time = end - start
         print(f"PID {pid} finished batch of size {len(batched_articles)} in {exec_time:.2f} sec")      
-        return df , exec_time, skipped_articles   
+        return decoder.to_frame() , exec_time, skipped_articles, unchanged_articles, pending_articles
 
     #  Fetch articles from globalStock database
-    def _fetch_articles_from_globalStock(self):
-        _, current_date, file_name, current_year, current_month, current_day = get_current_date()
+    def _fetch_articles_from_globalStock(self, run_date: datetime | None = None):
+        _, current_date, file_name, current_year, current_month, current_day = get_current_date(run_date)
         # print(f"Fetching articles for customer {customer} on {current_date} {type(current_date)}")
         path = check_Path_exits(customerId=self.customer, root_name="articles", current_year=current_year, current_month=current_month, current_day=current_day)
         
@@ -139,34 +195,45 @@ class stock_api:
         print(f"\033[32mSaving total number of fetched articles on {path} as number_of_articles.parquet\033[0m")
         return df["custArtId"].to_numpy()
     
-    def get_stockes_from_api(self):
-        current_timestamp, current_date, file_name, current_year, current_month, current_day = get_current_date()
-        print(f"\033[32mIngestion of current article stock started!\033[0m")
-        articles_22001 = self._fetch_articles_from_globalStock()        
-        
-        num_cores = os.cpu_count()        
-        data = articles_22001
+    def _crawl(self, data) -> tuple[pl.DataFrame, list]:
+        """Fetches the stock of the given articles, articles which failed are retried until all have been fetched.
+        Args:
+            data (np.ndarray): The article IDs to fetch.
+        Returns:
+            tuple[pl.DataFrame, list]: The decoded stock and the IDs of the articles which have not changed since the previous snapshot.
+        """
+        # The pool is sized to the upper concurrency limit, the controller keeps the actual number of in-flight requests adaptive.
+        num_workers = self.controller.max_limit
         
         finall_df = pl.DataFrame()
+        unchanged = []
         i = 1
-        while True:
+        while data.size:
             print(f"\033[32m{i}th iteration\033[0m")
             if i == 1:
-                chunks = np.array_split(data, num_cores)                  
+                # Strided chunks, every worker walks through the articles in the order of their priority.
+                chunks = [data[k::num_workers] for k in range(num_workers) if data[k::num_workers].size]
             else:
                 chunks = np.array_split(data, len(data)) 
-            results = Parallel(n_jobs=num_cores, backend="threading")(
+            results = Parallel(n_jobs=num_workers, backend="threading")(
                                     delayed(self._procedure)(chunk) for chunk in chunks        
         )   
             # Unpack results
-            batch_results, batch_times, skipped_articles = zip(*results)
+            batch_results, batch_times, skipped_articles, unchanged_articles, pending_articles = zip(*results)
+            unchanged.extend(item for sublist in unchanged_articles for item in sublist)
+            self.pending.extend(item for sublist in pending_articles for item in sublist)
             print("Execution times per batch:", batch_times)               
+            print(f"Concurrency after {i}th iteration: {self.controller}")
             print(skipped_articles)
             df = pl.concat(batch_results)    
             # print(df)
             finall_df = pl.concat([finall_df, df])
 
             data = np.array([item for sublist in skipped_articles if sublist for item in sublist])
+            if data.size and self.deadline is not None and time.time() >= self.deadline:
+                print(f"\033[33mWARNING: deadline reached, {data.size} failed articles are left to the follow-up pass\033[0m")
+                self.pending.extend(data.tolist())
+                break
             
             i += 1
             if data.size == 0:
@@ -175,20 +242,301 @@ class stock_api:
             else:                 
                 print(f"\033[33mWARNING: Articles {data} have been not fettched through API in {i - 1}th iteration\033[0m")
                 print(f"\033[33mRetrying the procedure for {data.size} articles\033[0m")
-        
+        return finall_df, unchanged
+
+    def _crawl_within_budget(self, data, current_timestamp: str, batch_size: int = 1000) -> tuple[spill_buffer, list]:
+        """Fetches the articles in bounded batches, the decoded batches are spilled to disk when the memory budget is approached.
+        Args:
+            data (np.ndarray): The article IDs to fetch.
+            current_timestamp (str): The timestamp of the run.
+            batch_size (int, optional): Number of articles of the first batch, the next batches are sized from the memory the first one took. Defaults to 1000.
+        Returns:
+            tuple[spill_buffer, list]: The buffer holding the decoded stock and the IDs of the unchanged articles.
+        """
+        _, _, file_name, *_ = get_current_date(datetime.fromisoformat(current_timestamp))
+        # Every article is fetched in one batch only, the batches are checked one by one for duplicate rows.
+        data = pl.Series(data).unique(maintain_order=True).to_numpy()
+        buffer = spill_buffer(f"/usr/local/airflow/include/data/{self.customer}/spill/stocks_{file_name}", budget_mb=self.memory_budget_mb)
+        unchanged = []
+        start = 0
+        while start < data.size:
+            batch = data[start:start + batch_size]
+            start += batch.size
+            df, batch_unchanged = self._crawl(batch)
+            unchanged.extend(batch_unchanged)
+            if not df.is_empty():
+                # One batch may take at most a quarter of the budget.
+                bytes_per_article = df.estimated_size() / batch.size
+                batch_size = max(1, int(self.memory_budget_mb * 1024 ** 2 * 0.25 / bytes_per_article))
+                df = self.validator.flag(df)
+            buffer.add(df)
+            print(f"\033[32m{start}/{data.size} articles fetched, next batch: {batch_size} articles\033[0m")
+        return buffer, unchanged
+
+    def _publish_snapshot(self, finall_df: pl.DataFrame | pl.LazyFrame, unchanged: list, current_timestamp: str, cache_parts: list[pl.DataFrame] | None = None) -> None:
+        """Writes the stock snapshot of a run and saves the execution date.
+        Args:
+            finall_df (pl.DataFrame | pl.LazyFrame): The decoded stock of the fetched articles, a LazyFrame over the flagged parts
+                (spilled batches in memory budget mode, the parts of the shards of a sharded crawl).
+            unchanged (list): The IDs of the articles which are carried forward from the previous snapshot.
+            current_timestamp (str): The timestamp of the run, '%Y-%m-%d %H:%M:%S'.
+            cache_parts (list[pl.DataFrame], optional): Recorded answers of the shards of a sharded crawl. Defaults to None.
+        Returns:
+            None
+        """
+        _, _, file_name, current_year, current_month, current_day = get_current_date(datetime.fromisoformat(current_timestamp))
+        # Combine the decoded answers with the unchanged articles of the previous snapshot.
+            # This has to happen before the snapshot file is overwritten, a rerun on the same day carries forward from it.
+            # Bad rows are quarantined before they reach the snapshot, the parts of a LazyFrame were checked when they were fetched.
+            # The carried forward rows passed them when the previous snapshot was written, their violations column is null (not checked).
+        frames = []
+        fetched = finall_df.lazy() if isinstance(finall_df, pl.LazyFrame) or not finall_df.columns else self.validator.flag(finall_df).lazy()
+        if fetched.collect_schema().names():
+            frames.append(fetched.with_columns(pl.lit(current_timestamp).str.to_datetime().alias('creDate')))
+        if unchanged:
+            # The carried forward rows keep the creDate of the run that fetched them, pending articles are recognizable as stale.
+            frames.append(self.cache.carry_forward(unchanged).lazy().with_columns(pl.lit(None, dtype=pl.UInt8).alias("violations")))
+        plan = (pl.concat(frames, how="diagonal_relaxed") if frames else pl.LazyFrame(schema={"violations": pl.UInt8, "creDate": pl.Datetime}))
+
         folder_path  = Path(f"/usr/local/airflow/include/data/{self.customer}/stocks/{current_year}/{current_month}/{current_day}")
         # ensure folder exists
         folder_path.mkdir(parents=True, exist_ok=True)
-        
-        if Path(f"{folder_path}/{file_name}.parquet").is_file():
-                Path(f"{folder_path}/{file_name}.parquet").unlink()
-                print(f"{folder_path}/{file_name}.parquet exists!")
-                print(f"{folder_path}/{file_name}.parquet overwrite!")
+        # The snapshot of an earlier run of the day is replaced by a new version, tasks reading it meanwhile keep reading the old version.
 
-        finall_df.unnest('stock').with_columns(pl.lit(current_timestamp).str.to_datetime().alias('creDate')).write_parquet(f"{folder_path}/{file_name}.parquet")
-        print(f"\033[32mSaving Current stock data on {folder_path} as {file_name}.parquet\033[0m")
-        print(f"\033[32mLength of collected Dataset: {finall_df.height}\033[0m")
-        print(finall_df.unnest('stock').with_columns(pl.lit(current_timestamp).str.to_datetime().alias('creDate')))
+        if isinstance(finall_df, pl.LazyFrame):
+            # Memory budget and sharded mode: the plan is executed once, the snapshot, the quarantine and the counts come from the same pass.
+            snapshot_path = folder_path.joinpath(f"{file_name}.{new_artifact_version()}.parquet")
+            with atomic_path(snapshot_path) as tmp:
+                n_rows = self.validator.sink(plan, tmp)
+            publish_artifact(folder_path, file_name, parquet=snapshot_path, n_rows=n_rows)
+            print(f"\033[32mLength of collected Dataset: {n_rows}, unchanged articles: {len(unchanged)}\033[0m")
+        else:
+            snapshot_df = self.validator.route(plan.collect())
+            # The Arrow IPC copy hands the decoded snapshot to the pivot task without another parquet decode.
+            snapshot_path = write_stock_artifact(snapshot_df, path=folder_path, file_name=file_name)
+            print(f"\033[32mSaving Current stock data on {folder_path} as {snapshot_path.name}\033[0m")
+            print(f"\033[32mLength of collected Dataset: {finall_df.height}, unchanged articles: {len(unchanged)}\033[0m")
+            print(snapshot_df)
+        self.validator.save(folder_path, file_name, current_timestamp)
+        if self.cache is not None:
+            if cache_parts is not None:
+                self.cache.combine([part.with_columns(pl.lit(str(snapshot_path)).alias("snapshot_path")) for part in cache_parts])
+            else:
+                self.cache.save(snapshot_path=str(snapshot_path))
 
         print(f"saving current execution time into last_20_executions_date table")
         self._save_execution_date(current_timestamp=datetime.fromisoformat(current_timestamp), current_year=current_year, current_month=current_month, current_day=current_day)
+
+    def get_stockes_from_api(self):
+        current_timestamp, *_ = get_current_date()
+        print(f"\033[32mIngestion of current article stock started!\033[0m")
+        articles_22001 = self._fetch_articles_from_globalStock(run_date=datetime.fromisoformat(current_timestamp))        
+        priorities = None
+        if self.deadline is not None:
+            # Fetch the important articles first, they are in the snapshot even if the deadline is hit.
+            run_date = datetime.fromisoformat(current_timestamp).date()
+            _, day_before, day_before_path = get_previous_working_day(self.customer, run_date)
+            previous_snapshot = resolve_artifact(day_before_path, day_before.strftime('%Y%m%d'), ipc=False) if day_before else None
+            previous_snapshot = str(previous_snapshot) if previous_snapshot is not None else None
+            priorities = article_priorities(self.customer, articles_22001, run_date=run_date, previous_snapshot=previous_snapshot)
+            articles_22001 = priorities["articleId"].to_numpy()
+
+        if self.memory_budget_mb is None:
+            finall_df, unchanged = self._crawl(articles_22001)
+            self._publish_snapshot(finall_df, unchanged + self._carried_pending(), current_timestamp)
+        else:
+            buffer, unchanged = self._crawl_within_budget(articles_22001, current_timestamp)
+            self._publish_snapshot(buffer.to_lazy(), unchanged + self._carried_pending(), current_timestamp)
+            buffer.cleanup()
+            print(f"\033[32mPeak memory of the stock ingestion: {peak_memory_mb():.0f} MB (budget {self.memory_budget_mb} MB)\033[0m")
+
+        if priorities is not None:
+            self._report_coverage(priorities, current_timestamp)
+
+    def _carried_pending(self) -> list:
+        # Articles left over at the deadline keep their stock of the previous snapshot until the follow-up pass, so the snapshot stays complete.
+        if not self.pending:
+            return []
+        if self.cache is None or self.cache.snapshot_path is None:
+            print(f"\033[33mWARNING no previous snapshot to carry forward the {len(self.pending)} pending articles, they are missing until the follow-up pass.\033[0m")
+            return []
+        return list(self.pending)
+
+    def _stocks_folder(self, current_timestamp: str) -> tuple[Path, str]:
+        _, _, file_name, current_year, current_month, current_day = get_current_date(datetime.fromisoformat(current_timestamp))
+        return Path(f"/usr/local/airflow/include/data/{self.customer}/stocks/{current_year}/{current_month}/{current_day}"), file_name
+
+    def _save_coverage(self, coverage: dict, current_timestamp: str) -> None:
+        # One row per pass, the follow-up pass appends the row of the completed snapshot.
+        folder_path, file_name = self._stocks_folder(current_timestamp)
+        coverage_path = folder_path.joinpath(f"coverage_{file_name}.parquet")
+        coverage_df = pl.DataFrame([coverage])
+        with folder_lock(folder_path, "coverage.lock"):
+            if coverage_path.is_file():
+                coverage_df = pl.concat([pl.read_parquet(coverage_path), coverage_df], how="diagonal_relaxed")
+            with atomic_path(coverage_path) as tmp:
+                coverage_df.write_parquet(tmp)
+        print(f"\033[32mCoverage of the stock snapshot saved on {coverage_path}: {coverage}\033[0m")
+
+    def _report_coverage(self, priorities: pl.DataFrame, current_timestamp: str) -> None:
+        """Saves the coverage report of a crawl with deadline and the articles left for the follow-up pass.
+        Args:
+            priorities (pl.DataFrame): The ranked articles returned by article_priorities().
+            current_timestamp (str): The timestamp of the run.
+        Returns:
+            None
+        """
+        folder_path, file_name = self._stocks_folder(current_timestamp)
+        is_pending = pl.col("articleId").is_in(pl.Series(self.pending, dtype=pl.Int64))
+        pending = priorities.filter(is_pending)
+        fresh = priorities.filter(~is_pending)
+        top = priorities.head(max(1, priorities.height // 10))
+        total_sales = priorities["recent_sales"].sum()
+        self._save_coverage({"pass": "deadline",
+                             "run_timestamp": datetime.fromisoformat(current_timestamp),
+                             "deadline": datetime.fromtimestamp(self.deadline),
+                             "published": datetime.now(),
+                             "n_articles": priorities.height,
+                             "n_fresh": fresh.height,
+                             "n_pending": pending.height,
+                             "n_carried_stale": len(self.pending) if self.cache is not None and self.cache.snapshot_path is not None else 0,
+                             # Share of the recent sales and of the top decile of the ranking that is fetched fresh.
+                             "sales_coverage": fresh["recent_sales"].sum() / total_sales if total_sales else 1.0,
+                             "top_decile_coverage": top.filter(~is_pending).height / top.height,
+                             "complete": pending.is_empty()}, current_timestamp)
+
+        pending_path = folder_path.joinpath(f"pending_{file_name}.parquet")
+        if not pending.is_empty():
+            with atomic_path(pending_path) as tmp:
+                pending.write_parquet(tmp)
+            print(f"\033[33mDeadline reached, {pending.height} articles left for the follow-up pass saved on {pending_path}\033[0m")
+        elif pending_path.is_file():
+            pending_path.unlink()
+
+    def complete_pending(self, current_timestamp: str | None = None) -> bool:
+        """Fetches the articles left over at the deadline of the last run and replaces their carried forward stock in its snapshot.
+        Args:
+            current_timestamp (str, optional): The timestamp of the run to complete. Defaults to the last execution.
+        Returns:
+            bool: True if the snapshot has been completed, False if nothing was pending.
+        """
+        if current_timestamp is None:
+            last_20_executions_date = pl.read_parquet(f"/usr/local/airflow/include/data/{self.customer}/last_20_executions_date.parquet").sort("execution_timestamp")
+            current_timestamp = last_20_executions_date["execution_timestamp"][-1].strftime('%Y-%m-%d %H:%M:%S')
+        folder_path, file_name = self._stocks_folder(current_timestamp)
+        pending_path = folder_path.joinpath(f"pending_{file_name}.parquet")
+        if not pending_path.is_file():
+            print(f"\033[32mNo pending articles for the run of {current_timestamp}, the snapshot is complete.\033[0m")
+            return False
+
+        pending = pl.read_parquet(pending_path)
+        print(f"\033[32mFollow-up pass: fetching {pending.height} pending articles of the run of {current_timestamp}\033[0m")
+        self.deadline = None
+        finall_df, unchanged = self._crawl(pending["articleId"].to_numpy())
+
+        completed_timestamp, *_ = get_current_date()
+        # Unchanged articles keep the rows carried forward from the previous snapshot.
+        fetched = pending.filter(~pl.col("articleId").is_in(pl.Series(unchanged, dtype=pl.Int64)))["articleId"]
+        snapshot_df = pl.concat([scan_stock_artifact(folder_path, file_name).filter(~pl.col("articleId").is_in(fetched)).collect(),
+                                 self.validator.split(finall_df).with_columns(pl.lit(completed_timestamp).str.to_datetime().alias('creDate'))], how="diagonal_relaxed")
+        snapshot_path = write_stock_artifact(snapshot_df, path=folder_path, file_name=file_name)
+        self.validator.save(folder_path, file_name, current_timestamp, append=True)
+        print(f"\033[32mSnapshot {snapshot_path} completed with {finall_df.height} rows of {fetched.len()} articles\033[0m")
+
+        if self.cache is not None:
+            # Add the answers of the follow-up pass to the answers of the deadline pass, all of them are in the new version of the snapshot.
+            deadline_part = pl.read_parquet(self.cache.path) if self.cache.path.is_file() else pl.DataFrame(schema=self.cache.schema)
+            self.cache.combine([deadline_part.filter(~pl.col("articleId").is_in(fetched)).with_columns(pl.lit(str(snapshot_path)).alias("snapshot_path")),
+                                self.cache.to_frame(snapshot_path)])
+
+        self._save_coverage({"pass": "follow-up",
+                             "run_timestamp": datetime.fromisoformat(current_timestamp),
+                             "published": datetime.fromisoformat(completed_timestamp),
+                             "n_articles": snapshot_df["articleId"].n_unique(),
+                             "n_fresh": pending.height,
+                             "n_pending": 0,
+                             "n_carried_stale": 0,
+                             "complete": True}, current_timestamp)
+        pending_path.unlink()
+        return True
+
+    def plan_shards(self, num_shards: int) -> list[dict]:
+        """Fetches the article list once and splits the crawl into shards which can run as mapped tasks on any worker.
+        Args:
+            num_shards (int): The number of shards.
+        Returns:
+            list[dict]: One dict per shard with the keys shard, num_shards and current_timestamp.
+        """
+        current_timestamp, *_ = get_current_date()
+        articles = self._fetch_articles_from_globalStock(run_date=datetime.fromisoformat(current_timestamp))
+        print(f"\033[32m{articles.size} articles split into {num_shards} shards\033[0m")
+        return [{"shard": shard, "num_shards": num_shards, "current_timestamp": current_timestamp} for shard in range(num_shards)]
+
+    def _shards_path(self, current_timestamp: str) -> Path:
+        folder_path, _ = self._stocks_folder(current_timestamp)
+        return folder_path.joinpath("shards")
+
+    def fetch_shard(self, shard: int, num_shards: int, current_timestamp: str) -> dict:
+        """Fetches the articles of one shard (custArtId modulo num_shards) and writes its part under the shards folder of the day.
+        Args:
+            shard (int): The shard number.
+            num_shards (int): The number of shards.
+            current_timestamp (str): The timestamp of the run returned by plan_shards().
+        Returns:
+            dict: The paths of the part, only they go through XCom: shard, stock (decoded stock, Arrow IPC), unchanged (article IDs) and cache (recorded answers).
+        """
+        _, _, file_name, current_year, current_month, current_day = get_current_date(datetime.fromisoformat(current_timestamp))
+        articles_path = f"/usr/local/airflow/include/data/{self.customer}/articles/{current_year}/{current_month}/{current_day}/article_{file_name}.parquet"
+        articles = (pl.scan_parquet(articles_path)
+                                    .filter(pl.col("custArtId") % num_shards == shard)
+                                    .collect()["custArtId"].to_numpy())
+        print(f"\033[32mShard {shard}/{num_shards}: fetching {articles.size} articles\033[0m")
+        finall_df, unchanged = self._crawl(articles)
+        if not finall_df.is_empty():
+            # The articles of a shard are not in any other shard, its duplicate rows are found here.
+            finall_df = self.validator.flag(finall_df)
+
+        shards_path = self._shards_path(current_timestamp)
+        shards_path.mkdir(parents=True, exist_ok=True)
+        # A retried shard writes a new version of its part, the merge only reads the paths returned by the successful try.
+        version = new_artifact_version()
+        part = {"shard": shard,
+                "stock": str(shards_path.joinpath(f"stock_{shard}.{version}.arrow")),
+                "unchanged": str(shards_path.joinpath(f"unchanged_{shard}.{version}.parquet")),
+                "cache": str(shards_path.joinpath(f"cache_{shard}.{version}.parquet")) if self.cache is not None else None}
+        with atomic_path(part["stock"]) as tmp:
+            finall_df.write_ipc(tmp, compression="uncompressed")
+        with atomic_path(part["unchanged"]) as tmp:
+            pl.DataFrame({"articleId": unchanged}, schema={"articleId": pl.Int64}).write_parquet(tmp)
+        if self.cache is not None:
+            # The snapshot path of the cached answers is set by merge_shards(), the version of the snapshot is not known yet.
+            with atomic_path(part["cache"]) as tmp:
+                self.cache.to_frame().write_parquet(tmp)
+        print(f"\033[32mPart of shard {shard} saved on {shards_path}\033[0m")
+        return part
+
+    def merge_shards(self, parts: list[dict], num_shards: int, current_timestamp: str) -> None:
+        """Assembles the snapshot from the parts of all shards and saves the execution date, the stock of the parts is scanned lazily.
+        Args:
+            parts (list[dict]): The paths returned by fetch_shard().
+            num_shards (int): The number of shards.
+            current_timestamp (str): The timestamp of the run returned by plan_shards().
+        Returns:
+            None
+        """
+        missing = sorted(set(range(num_shards)) - {part["shard"] for part in parts})
+        if missing:
+            raise ValueError(f"\033[31mThe parts of the shards {missing} are missing\033[0m")
+
+        finall_df = pl.concat([pl.scan_ipc(part["stock"]) for part in parts], how="diagonal_relaxed")
+        unchanged = pl.concat([pl.read_parquet(part["unchanged"]) for part in parts])["articleId"].to_list()
+        cache_parts = [pl.read_parquet(part["cache"]) for part in parts if part["cache"] is not None]
+        self._publish_snapshot(finall_df, unchanged, current_timestamp, cache_parts=cache_parts if self.cache is not None else None)
+
+        shards_path = self._shards_path(current_timestamp)
+        for part in parts:
+            for name in ("stock", "unchanged", "cache"):
+                if part[name] is not None:
+                    Path(part[name]).unlink(missing_ok=True)
+        if shards_path.is_dir() and not any(shards_path.iterdir()):
+            shards_path.rmdir()
@@ -0,0 +1,180 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+# Cells of a store that has no row for an article/size on that day.
+MISSING = np.iinfo(np.int16).min
+
+
+class stock_cube:
+    """Dense article/size x store matrix of the stock of a day, saved as int16 .npy file and memory-mapped on read.
+        The row keys (articleId, size) and the column keys (branch) are shared by all days of a customer, new keys are appended,
+        so the index of a key never changes and the cubes of two days can be compared cell by cell.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        chunk_rows (int): Number of rows compared at once by diff(). default is 65_536.
+    Methods:
+        build(day, stocks): Saves the cube of a day from its stock snapshot.
+        load(day): Returns the memory-mapped cube of a day.
+        store_vector(articleId, day): Returns the stock of an article per size at all stores on a day.
+        diff(day, previous_day, stores): Returns the cells whose stock changed between two days.
+    """
+    def __init__(self, customer: str = '22001', chunk_rows: int = 65_536):
+        self.customer = customer
+        self.chunk_rows = chunk_rows
+        self.root = Path(f"/usr/local/airflow/include/data/{customer}/cube")
+        self.rows_path = self.root.joinpath("rows.parquet")
+        self.columns_path = self.root.joinpath("columns.parquet")
+        self._keys = None
+
+    def _cube_path(self, day: date) -> Path:
+        return Path(f"/usr/local/airflow/include/data/{self.customer}/stocks/{day.strftime('%Y')}/{day.strftime('%B')}/{day.strftime('%d')}/stockCube_{day.strftime('%Y%m%d')}.npy")
+
+    @contextmanager
+    def _lock(self):
+        # Pivot tasks of several days (e.g. the replay) may append keys at the same time.
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root.joinpath("keys.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _replace(df: pl.DataFrame, path: Path) -> None:
+        tmp = path.with_suffix(".tmp")
+        df.write_parquet(tmp)
+        os.replace(tmp, path)
+
+    def keys(self) -> tuple[pl.DataFrame, pl.DataFrame]:
+        """Returns the row keys (articleId, size, row) and the column keys (branch, column)."""
+        if self._keys is None:
+            rows = pl.read_parquet(self.rows_path) if self.rows_path.is_file() else pl.DataFrame(schema={"articleId": pl.Int64, "size": pl.Int32, "row": pl.Int64})
+            columns = pl.read_parquet(self.columns_path) if self.columns_path.is_file() else pl.DataFrame(schema={"branch": pl.String, "column": pl.Int64})
+            self._keys = rows, columns
+        return self._keys
+
+    def _append_keys(self, keys: pl.DataFrame, known: pl.DataFrame, on: list[str], index: str) -> pl.DataFrame:
+        new_keys = keys.join(known, on=on, how="anti").sort(on)
+        return pl.concat([known, new_keys.with_row_index(index, offset=known.height).select(on + [index]).cast({index: pl.Int64})])
+
+    def build(self, day: date, stocks: pl.LazyFrame) -> Path:
+        """Saves the cube of a day.
+        Args:
+            day (date): The day of the snapshot.
+            stocks (pl.LazyFrame): The snapshot as returned by stocksDatabase.scan_stocks_files().
+        Returns:
+            Path: The .npy file of the cube.
+        """
+        cells = (stocks.select(pl.col("articleId").cast(pl.Int64), pl.col("size").cast(pl.Int32), pl.col("branch").cast(pl.String), pl.col("current_amount").cast(pl.Int32))
+                        .group_by(["articleId", "size", "branch"])
+                        .agg(pl.col("current_amount").first())
+                        .collect())
+
+        with self._lock():
+            self._keys = None
+            rows, columns = self.keys()
+            rows = self._append_keys(cells.select("articleId", "size").unique(), rows, ["articleId", "size"], "row")
+            columns = self._append_keys(cells.select("branch").unique(), columns, ["branch"], "column")
+            self._replace(rows, self.rows_path)
+            self._replace(columns, self.columns_path)
+            self._keys = rows, columns
+
+        cells = cells.join(rows, on=["articleId", "size"]).join(columns, on="branch")
+        amounts = cells["current_amount"]
+        if amounts.null_count() < amounts.len() and (amounts.min() <= MISSING or amounts.max() > np.iinfo(np.int16).max):
+            print(f"\033[33mWARNING stock amounts out of the int16 range on {day} are clipped.\033[0m")
+        cube = np.full((rows.height, columns.height), MISSING, dtype=np.int16)
+        # A row without amount is stored like a missing row, to_numpy() would turn the nulls into floats.
+        cube[cells["row"].to_numpy(), cells["column"].to_numpy()] = (amounts.clip(MISSING + 1, np.iinfo(np.int16).max)
+                                                                            .fill_null(MISSING).cast(pl.Int16).to_numpy())
+
+        cube_path = self._cube_path(day)
+        cube_path.parent.mkdir(parents=True, exist_ok=True)
+        # np.save appends .npy to names without it.
+        tmp = cube_path.with_name(cube_path.stem + ".tmp.npy")
+        np.save(tmp, cube)
+        os.replace(tmp, cube_path)
+        print(f"\033[32mStock cube {cube.shape[0]} x {cube.shape[1]} ({cube.nbytes / 1024 ** 2:.1f} MB) saved as {cube_path}\033[0m")
+        return cube_path
+
+    def load(self, day: date) -> np.ndarray:
+        """Returns the memory-mapped cube of a day. Rows and columns of keys added after that day are not part of it, they are MISSING."""
+        cube_path = self._cube_path(day)
+        if not cube_path.is_file():
+            raise FileNotFoundError(f"\033[31mNo stock cube found for {day} at {cube_path}\033[0m")
+        cube = np.load(cube_path, mmap_mode="r")
+        # Keys appended by another process after the keys were read.
+        if self._keys is not None and (cube.shape[0] > self._keys[0].height or cube.shape[1] > self._keys[1].height):
+            self._keys = None
+        return cube
+
+    def store_vector(self, articleId: int, day: date) -> pl.DataFrame:
+        """Returns the stock of an article per size at all stores on a day.
+        Args:
+            articleId (int): The article ID.
+            day (date): The day of the snapshot.
+        Returns:
+            pl.DataFrame: One row per size with the columns articleId, size and one column per store, null where the store has no stock row.
+        """
+        cube = self.load(day)
+        rows, columns = self.keys()
+        rows = rows.filter(pl.col("articleId") == articleId, pl.col("row") < cube.shape[0]).sort("size")
+        columns = columns.filter(pl.col("column") < cube.shape[1])
+        # Only the rows of the article are read from the memory-mapped file.
+        vectors = cube[rows["row"].to_numpy()][:, columns["column"].to_numpy()]
+        branches = columns["branch"].to_list()
+        return (rows.select("articleId", "size")
+                    .with_columns([pl.Series(branch, vectors[:, i]) for i, branch in enumerate(branches)])
+                    .with_columns([pl.when(pl.col(branch) != MISSING).then(pl.col(branch)).alias(branch) for branch in branches]))
+
+    @staticmethod
+    def _block(cube: np.ndarray, start: int, stop: int, n_columns: int) -> np.ndarray:
+        # Rows of the block padded with MISSING for the keys the cube does not have.
+        block = np.full((stop - start, n_columns), MISSING, dtype=np.int16)
+        part = cube[start:min(stop, cube.shape[0]), :n_columns]
+        block[:part.shape[0], :part.shape[1]] = part
+        return block
+
+    def diff(self, day: date, previous_day: date, stores: list[str] | None = None) -> pl.DataFrame:
+        """Returns the cells whose stock changed between two days, compared chunk by chunk of rows.
+        Args:
+            day (date): The day to compare.
+            previous_day (date): The day to compare with.
+            stores (list[str], optional): Only compare these branches. Defaults to all branches.
+        Returns:
+            pl.DataFrame: The columns articleId, size, branch, old and new, old/new are null where the article had no stock row.
+        """
+        current, previous = self.load(day), self.load(previous_day)
+        rows, columns = self.keys()
+        n_rows, n_columns = max(current.shape[0], previous.shape[0]), max(current.shape[1], previous.shape[1])
+        if stores is not None:
+            selected = columns.filter(pl.col("branch").is_in(stores), pl.col("column") < n_columns)["column"].to_numpy()
+        else:
+            selected = np.arange(n_columns)
+
+        changes = []
+        for start in range(0, n_rows, self.chunk_rows):
+            stop = min(start + self.chunk_rows, n_rows)
+            new = self._block(current, start, stop, n_columns)[:, selected]
+            old = self._block(previous, start, stop, n_columns)[:, selected]
+            changed_rows, changed_columns = np.nonzero(new != old)
+            changes.append(pl.DataFrame({"row": changed_rows.astype(np.int64) + start,
+                                         "column": selected[changed_columns].astype(np.int64),
+                                         "old": old[changed_rows, changed_columns],
+                                         "new": new[changed_rows, changed_columns]}))
+        if not changes:
+            return pl.DataFrame(schema={"articleId": pl.Int64, "size": pl.Int32, "branch": pl.String, "old": pl.Int16, "new": pl.Int16})
+        return (pl.concat(changes)
+                    .join(rows, on="row")
+                    .join(columns, on="column")
+                    .select("articleId", "size", "branch",
+                            pl.when(pl.col("old") != MISSING).then(pl.col("old")).alias("old"),
+                            pl.when(pl.col("new") != MISSING).then(pl.col("new")).alias("new"))
+                    .sort(["articleId", "size", "branch"]))
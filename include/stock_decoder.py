@@ -0,0 +1,69 @@
+import json
+from array import array
+
+import numpy as np
+import polars as pl
+
+try:
+    import msgspec
+except ImportError:  # msgspec is optional, the standard json module is used without it.
+    msgspec = None
+
+
+if msgspec is not None:
+    class StockEntry(msgspec.Struct):
+        branch: int
+        size: int
+        sizeIndex: int
+        amount: int
+
+    class StockRecord(msgspec.Struct):
+        articleId: int
+        stock: StockEntry
+
+    # strict=False accepts numbers sent as strings, e.g. "99" for the warehouse branch.
+    _decoder = msgspec.json.Decoder(list[list[StockRecord]], strict=False)
+
+
+class stock_decoder:
+    """Decodes raw stock API answers straight into typed column buffers.
+        The answers are parsed into typed structs (msgspec) instead of Python dicts when msgspec is installed,
+        no DataFrame is built per article, to_frame() creates one DataFrame from the buffers without copying.
+    Attributes:
+        schema (dict): The fixed schema of the decoded stock (articleId, branch, size, sizeIndex, amount).
+    Methods:
+        append(content): Decodes the raw bytes of one API answer into the column buffers.
+        to_frame(): Returns the decoded stock as a DataFrame.
+    """
+    schema = {"articleId": pl.Int64, "branch": pl.Int32, "size": pl.Int32, "sizeIndex": pl.Int32, "amount": pl.Int32}
+    typecodes = {"articleId": "q", "branch": "i", "size": "i", "sizeIndex": "i", "amount": "i"}
+
+    def __init__(self):
+        self._buffers = {name: array(code) for name, code in self.typecodes.items()}
+
+    def __len__(self):
+        return len(self._buffers["articleId"])
+
+    def append(self, content: bytes) -> None:
+        """Decodes the raw bytes of one API answer.
+        Args:
+            content (bytes): The body of the answer, a JSON list whose first element holds the stock records of the article.
+        Returns:
+            None
+        """
+        if msgspec is not None:
+            records = _decoder.decode(content)[0]
+            columns = ([r.articleId for r in records], [r.stock.branch for r in records], [r.stock.size for r in records],
+                       [r.stock.sizeIndex for r in records], [r.stock.amount for r in records])
+        else:
+            records = json.loads(content)[0]
+            columns = ([int(r["articleId"]) for r in records], [int(r["stock"]["branch"]) for r in records], [int(r["stock"]["size"]) for r in records],
+                       [int(r["stock"]["sizeIndex"]) for r in records], [int(r["stock"]["amount"]) for r in records])
+        # Columns are built completely before they are appended, a broken answer never leaves the buffers misaligned.
+        for name, values in zip(self._buffers, columns):
+            self._buffers[name].extend(values)
+
+    def to_frame(self) -> pl.DataFrame:
+        return pl.DataFrame({name: np.frombuffer(buffer, dtype=buffer.typecode) if len(buffer) else np.array([], dtype=buffer.typecode)
+                             for name, buffer in self._buffers.items()},
+                            schema=self.schema)
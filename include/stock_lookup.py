@@ -0,0 +1,108 @@
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from plugins.g_utils import atomic_path, resolve_pivot
+
+# Rows per row group of the pivot files, a point lookup decodes only the row groups of one article.
+PIVOT_ROW_GROUP_SIZE = 20_000
+
+
+def build_article_index(parquet_path) -> Path:
+    """Builds the sidecar index articleId -> row groups of a pivot file.
+        Every row group that holds rows of an article is listed, the pivots are sorted by article so it is mostly one row group.
+    Args:
+        parquet_path (str | Path): The pivot parquet file.
+    Returns:
+        Path: The index file, saved next to the pivot as <name>.index.parquet.
+    """
+    parquet_path = Path(parquet_path)
+    parquet_file = pq.ParquetFile(parquet_path)
+    # Only the articleId column of every row group is read.
+    frames = [pl.DataFrame({"articleId": pl.from_arrow(parquet_file.read_row_group(row_group, columns=["articleId"]))["articleId"].unique(),
+                            "row_group": row_group})
+              for row_group in range(parquet_file.num_row_groups)]
+    index_path = parquet_path.with_suffix(".index.parquet")
+    if not frames:
+        return index_path
+    index = (pl.concat(frames)
+                .group_by("articleId")
+                .agg(pl.col("row_group").unique().sort().alias("row_groups"))
+                .with_columns(pl.lit(parquet_path.name).alias("file"))
+                .sort("articleId"))
+    with atomic_path(index_path) as tmp:
+        index.write_parquet(tmp)
+    print(f"\033[32mArticle index of {parquet_file.num_row_groups} row groups saved as {index_path}\033[0m")
+    return index_path
+
+
+class stock_lookup:
+    """Point lookups of the stock of one article at all stores on a given date.
+        The sidecar index written next to each pivot file points to the row groups of an article, so only these row groups are decoded.
+        Answers of hot articles are kept in an in-process LRU cache keyed on the published version of the pivot file,
+        a republished day is read again.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        cache_size (int): Number of (article, pivot file) answers kept in the LRU cache. default is 1024.
+    Methods:
+        store_vector(articleId, day): Returns the stock of an article per size at all stores on a date.
+    """
+    def __init__(self, customer: str = '22001', cache_size: int = 1024):
+        self.customer = customer
+        self._vector = lru_cache(maxsize=cache_size)(self._read_vector)
+        self._index = lru_cache(maxsize=64)(self._read_index)
+
+    def _pivot_path(self, day: date) -> Path | None:
+        folder = Path(f"/usr/local/airflow/include/data/{self.customer}/stocks/{day.strftime('%Y')}/{day.strftime('%B')}/{day.strftime('%d')}")
+        # Days saved in normalized storage mode only have the store matrix, it holds the same store vectors.
+            # The published version of the parquet file is read, the article index belongs to it.
+        return resolve_pivot(folder, day, ipc=False)[1]
+
+    def _read_index(self, pivot_path: Path) -> pl.DataFrame | None:
+        index_path = pivot_path.with_suffix(".index.parquet")
+        if not index_path.is_file():
+            return None
+        return pl.read_parquet(index_path)
+
+    def store_vector(self, articleId: int, day: date) -> pl.DataFrame:
+        """Returns the stock of an article per size at all stores on a date.
+        Args:
+            articleId (int): The article ID.
+            day (date): The date of the snapshot.
+        Returns:
+            pl.DataFrame: One row per size with the columns articleId, size and one column per store.
+        """
+        # The published version is resolved on every call, only the answer of one version is cached.
+        pivot_path = self._pivot_path(day)
+        if pivot_path is None:
+            raise FileNotFoundError(f"\033[31mNo pivotArtStoresStock or pivotMatrix file found for {day}\033[0m")
+        return self._vector(articleId, pivot_path)
+
+    def _read_vector(self, articleId: int, pivot_path: Path) -> pl.DataFrame:
+        index = self._index(pivot_path)
+        if index is None:
+            # Pivots written before the index existed, parquet statistics still prune most row groups.
+            print(f"\033[33mWARNING no article index found for {pivot_path}, scanning the file.\033[0m")
+            df = pl.scan_parquet(pivot_path).filter(pl.col("articleId") == articleId).collect()
+        else:
+            entry = index.filter(pl.col("articleId") == articleId)
+            if entry.is_empty():
+                df = pl.DataFrame()
+            else:
+                if "row_groups" in entry.columns:
+                    row_groups = entry["row_groups"][0].to_list()
+                else:
+                    # Indexes of pivots sorted by article only kept the range of row groups.
+                    row_groups = list(range(entry["first_row_group"][0], entry["last_row_group"][0] + 1))
+                table = pq.ParquetFile(pivot_path).read_row_groups(row_groups)
+                df = pl.from_arrow(table).filter(pl.col("articleId") == articleId)
+
+        if df.is_empty():
+            return df
+        letters = tuple("0123456789")
+        store_columns = [col for col in df.columns if col.startswith(letters)]
+        # The store columns repeat on every branch row of an article/size, one row per size is enough.
+        return df.select(["articleId", "size"] + store_columns).unique(subset=["articleId", "size"], keep="first").sort("size")
@@ -0,0 +1,156 @@
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+
+from plugins.g_utils import atomic_path, folder_lock
+
+
+class stock_validator:
+    """Checks the decoded stock before it is written into the snapshot, bad rows are moved to a quarantine file.
+        All checks are computed by one expression, every violation is one bit of the violations column:
+        1 out_of_range (amount, size or sizeIndex outside Int16, they would wrap around in the pivot),
+        2 negative_stock, 4 duplicate_key (every but the first row of an articleId/branch/size), 8 unknown_branch (not in the activeStors file).
+        Rows with a null violations column were not checked (carried forward from a snapshot that already passed the checks).
+        Missing amounts are not checked, the decoder already rejects an answer without amount.
+    Attributes:
+        customer (str): Customer identifier. default is '22001'.
+        known_branches (list[int] | None): The store numbers of the activeStors file, None if the file does not exist (no branch check).
+    Methods:
+        flag(df): Adds the violations column to a DataFrame, e.g. one batch or one shard of the crawl.
+        route(checked): Keeps the bad rows of a flagged DataFrame for the quarantine and returns the rows for the snapshot.
+        sink(checked, target): Writes the rows of a flagged LazyFrame for the snapshot, keeps the bad rows in the same pass.
+        split(df): flag() and route() of a DataFrame.
+        save(folder_path, file_name, current_timestamp): Saves the quarantined rows and the summary of the run.
+    """
+    checks = {"out_of_range": 1, "negative_stock": 2, "duplicate_key": 4, "unknown_branch": 8}
+    key = ["articleId", "branch", "size"]
+
+    def __init__(self, customer: str = '22001'):
+        self.customer = customer
+        # activeStors maps custStoreId -> store number (the branch of the stock) in its only row.
+        active_stores_path = Path(f"/usr/local/airflow/include/data/{customer}/activeStors_{customer}.parquet")
+        if active_stores_path.is_file():
+            self.known_branches = [int(store) for store in pl.read_parquet(active_stores_path).row(0)]
+        else:
+            self.known_branches = None
+            print(f"\033[31mWARNING {active_stores_path} does not exist, the stock rows are not checked for unknown branches.\033[0m")
+        self._reset()
+
+    def _reset(self) -> None:
+        self._quarantined = []
+        self._counts = dict.fromkeys(self.checks, 0)
+        self._n_rows = 0
+
+    def _violations(self) -> pl.Expr:
+        int16 = (-2 ** 15, 2 ** 15 - 1)
+        flags = [pl.when(~pl.col("amount").is_between(*int16) | ~pl.col("size").is_between(*int16) | ~pl.col("sizeIndex").is_between(*int16))
+                    .then(self.checks["out_of_range"]).otherwise(0),
+                 pl.when(pl.col("amount") < 0).then(self.checks["negative_stock"]).otherwise(0),
+                 pl.when(~pl.struct(self.key).is_first_distinct()).then(self.checks["duplicate_key"]).otherwise(0)]
+        if self.known_branches is not None:
+            flags.append(pl.when(~pl.col("branch").cast(pl.Int64).is_in(self.known_branches)).then(self.checks["unknown_branch"]).otherwise(0))
+        # The bits are distinct, their sum is the bitmask.
+        return pl.sum_horizontal(flags).cast(pl.UInt8).alias("violations")
+
+    def flag(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Adds the violations column to a bounded part of the decoded stock, e.g. one batch of a crawl within a memory budget.
+            Every article is fetched in one part only, so the duplicates of a key are always in the same part.
+        Args:
+            df (pl.DataFrame): Decoded stock with the columns articleId, branch, size, sizeIndex and amount.
+        Returns:
+            pl.DataFrame: The frame with the violations column.
+        """
+        return df.with_columns(self._violations())
+
+    def _count(self) -> list[pl.Expr]:
+        return [pl.col("violations").count().alias("n_rows"),
+                *[(pl.col("violations") // bit % 2 == 1).sum().alias(name) for name, bit in self.checks.items()]]
+
+    def _add_counts(self, counts: dict) -> None:
+        self._n_rows += counts.pop("n_rows")
+        for name, count in counts.items():
+            self._counts[name] += count
+
+    def route(self, checked: pl.DataFrame) -> pl.DataFrame:
+        """Counts the violations of a flagged DataFrame, keeps its bad rows for the quarantine and returns the rows for the snapshot.
+        Args:
+            checked (pl.DataFrame): A frame returned by flag(), possibly concatenated with unchecked rows (violations null).
+        Returns:
+            pl.DataFrame: The unchecked rows and the rows without violation, without the violations column.
+        """
+        counts = checked.select(self._count()).row(0, named=True)
+        self._add_counts(counts)
+        if any(counts.values()):
+            self._quarantined.append(checked.filter(pl.col("violations") > 0))
+        return checked.filter(pl.col("violations").fill_null(0) == 0).drop("violations")
+
+    def sink(self, checked: pl.LazyFrame, target) -> int:
+        """Streams the rows of a flagged LazyFrame without violation into a parquet file, the counts and the bad rows come from the same pass.
+        Args:
+            checked (pl.LazyFrame): Flagged parts, possibly concatenated with unchecked rows (violations null).
+            target (Path): The parquet file.
+        Returns:
+            int: The number of rows written.
+        """
+        _, quarantined, counts = pl.collect_all([checked.filter(pl.col("violations").fill_null(0) == 0).drop("violations").sink_parquet(target, lazy=True),
+                                                 checked.filter(pl.col("violations") > 0),
+                                                 checked.select(*self._count(), (pl.col("violations").fill_null(0) == 0).sum().alias("n_valid"))],
+                                                engine="streaming")
+        counts = counts.row(0, named=True)
+        n_valid = counts.pop("n_valid")
+        self._add_counts(counts)
+        if not quarantined.is_empty():
+            self._quarantined.append(quarantined)
+        return n_valid
+
+    def split(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Returns the valid rows of a DataFrame of decoded stock and keeps the bad rows for the quarantine.
+        Args:
+            df (pl.DataFrame): Decoded stock with the columns articleId, branch, size, sizeIndex and amount.
+        Returns:
+            pl.DataFrame: The rows without violation.
+        """
+        if df.is_empty():
+            return df
+        return self.route(self.flag(df))
+
+    def save(self, folder_path, file_name: str, current_timestamp: str, append: bool = False) -> dict:
+        """Saves the quarantined rows as quarantine_{file_name}.parquet and appends the summary of the run to validation_{file_name}.parquet.
+        Args:
+            folder_path (Path): The folder of the snapshot.
+            file_name (str): The name of the snapshot, YYYYMMDD.
+            current_timestamp (str): The timestamp of the run.
+            append (bool, optional): Add the rows to the quarantine of the run instead of replacing it, used by the follow-up pass. Defaults to False.
+        Returns:
+            dict: The summary, number of checked and quarantined rows and number of rows per violation.
+        """
+        folder_path = Path(folder_path)
+        n_quarantined = sum(df.height for df in self._quarantined)
+        summary = {"run_timestamp": datetime.fromisoformat(current_timestamp), "validated": datetime.now(),
+                   "n_rows": self._n_rows, "n_quarantined": n_quarantined, **self._counts}
+
+        quarantine_path = folder_path.joinpath(f"quarantine_{file_name}.parquet")
+        summary_path = folder_path.joinpath(f"validation_{file_name}.parquet")
+        # Both files are replaced atomically, overlapping runs of the day update them one after the other.
+        with folder_lock(folder_path, "validation.lock"):
+            if not append and quarantine_path.is_file():
+                quarantine_path.unlink()
+            if self._quarantined:
+                quarantine_df = pl.concat(self._quarantined, how="diagonal_relaxed").with_columns(pl.lit(summary["run_timestamp"]).alias("run_timestamp"))
+                if quarantine_path.is_file():
+                    quarantine_df = pl.concat([pl.read_parquet(quarantine_path), quarantine_df], how="diagonal_relaxed")
+                with atomic_path(quarantine_path) as tmp:
+                    quarantine_df.write_parquet(tmp)
+                print(f"\033[31mWARNING {n_quarantined} of {self._n_rows} stock rows quarantined on {quarantine_path}: {self._counts}\033[0m")
+            else:
+                print(f"\033[32mAll {self._n_rows} stock rows passed the validation\033[0m")
+
+            # One summary row per pass, a rerun or the follow-up pass of a crawl with deadline appends its row.
+            summary_df = pl.DataFrame([summary])
+            if summary_path.is_file():
+                summary_df = pl.concat([pl.read_parquet(summary_path), summary_df], how="diagonal_relaxed")
+            with atomic_path(summary_path) as tmp:
+                summary_df.write_parquet(tmp)
+        self._reset()
+        return summary
@@ -4,12 +4,14 @@ import datetime
 
 from datetime import date 
 import os
+import shutil
 import time 
 import traceback
 import requests 
 from pathlib import Path
 import polars as pl
 import numpy as np
+import pyarrow.dataset as ds
 from joblib import Parallel, delayed 
 from sqlalchemy import create_engine 
 
@@ -17,6 +19,13 @@ from include.customer import customer_data
 from plugins.g_utils import  get_last_two_working_days
 from plugins.g_utils import check_Path_exits
 from plugins.g_utils import get_current_date
+from plugins.g_utils import get_previous_working_day
+from plugins.g_utils import scan_stock_artifact, sink_stock_artifact, write_stock_artifact
+from plugins.g_utils import resolve_artifact, resolve_pivot, retire_artifact, PIVOT_ARTIFACTS
+from include.memory_budget import current_memory_mb, peak_memory_mb, spill_buffer
+from include.stock_lookup import PIVOT_ROW_GROUP_SIZE, build_article_index
+from include.stock_cube import stock_cube
+from include.sales import read_sales
 
 
 class Wrapper:
@@ -46,9 +55,9 @@ class Wrapper:
         return str(self.values)
     
     def save(self) -> None:       
-        if not self.values.is_empty():             
-            print(f"\033[32mData saved on: {self.path} as {self.file_name}.parquet\033[0m")
-            self.values.write_parquet(f"{self.path}/{self.file_name}.parquet")
+        # An empty result is published as well, it replaces the result of an earlier run of the day.
+        if self.path != "No_path":             
+            write_stock_artifact(self.values, path=self.path, file_name=self.file_name, ipc=False)
 
 class customer_stocks(customer_data):
     """Abstract base class for customer stocks operations.
@@ -101,39 +110,77 @@ class stocksDatabase(customer_stocks):
         customer_stocks: An abstract base class for customer stocks operations. 
     attributes:
         customerId (str): The ID of the customer. default is '22001'.
+        execution_date (date, optional): Recompute the stocks of this day instead of the last execution of the dag, used by the historical replay. default is None.
+        storage_mode (str): 'wide' saves the pivot joined onto every row of the snapshot (pivotArtStoresStock),
+            'normalized' saves only the article/size x store matrix once (pivotMatrix), the wide view is built by scan_pivot() when asked. default is 'wide'.
     methods:
+        scan_stocks_files(day): Lazily scans the stock data of the current execution date or of the given day.
+        scan_pivot(day, stores): Lazily reads the wide view of a day's stocks in either storage mode.
         read_parquet_stocks_files(): Reads parquet files containing stock data.
-        daily_stocks(): Fetches and processes daily stocks.
+        daily_stocks(streaming, memory_budget_mb): Fetches and processes daily stocks, optionally as a lazy streaming plan.
+        daily_stocks_lazy(): Builds the lazy plan from the snapshot scan through pivot, join and casting.
+        daily_stocks_within_budget(memory_budget_mb): Pivots and joins the articles in bounded batches within a memory budget.
         two_daily_stock_changes(): Compares stock changes between two days. 
+        replenishment_candidates(cover_days, min_stock, warehouse_reserve): Suggests transfers from the central warehouse to the stores.
         save(path): Saves the daily stocks data to the specified path.
     """
-    def __init__(self, customerId: str = '22001'):
+    storage_modes = ('wide', 'normalized')
+    candidates_schema = {"articleId": pl.Int64, "size": pl.Int16, "branch": pl.String, "stock": pl.Int32, "sales": pl.Int32,
+                         "threshold": pl.Int32, "need": pl.Int32, "warehouse_stock": pl.Int32, "transfer": pl.Int32}
+
+    def __init__(self, customerId: str = '22001', storage_mode: str = 'wide', execution_date=None):
         super().__init__(customerId=customerId)
+        if storage_mode not in self.storage_modes:
+            raise ValueError(f"\033[31mUnknown storage mode {storage_mode}, use one of {self.storage_modes}\033[0m")
+        self.storage_mode = storage_mode
         # Get the last two days that dag has run automatically for fetching the stocks. 
             # Note: this may not be today and yesterday due to weekends or holidays.
-        self.current_execution_date, self.a_day_before, self.a_day_before_path = get_last_two_working_days(customerId=self.customerId)       
+        if execution_date is None:
+            self.current_execution_date, self.a_day_before, self.a_day_before_path = get_last_two_working_days(customerId=self.customerId)       
+        else:
+            self.current_execution_date, self.a_day_before, self.a_day_before_path = get_previous_working_day(customerId=self.customerId, day=execution_date)
         print(f"current execution date: {self.current_execution_date}, day before: {self.a_day_before}")      
         
-    def read_parquet_stocks_files(self) -> pl.DataFrame:
-        # Read today's fetched stock (the last execution of the dag) parquet files.
-        source1 = f"/usr/local/airflow/include/data/{self.customerId}/stocks/{self.current_execution_date.strftime('%Y')}/{self.current_execution_date.strftime('%B')}/{self.current_execution_date.strftime('%d')}/{self.current_execution_date.strftime('%Y%m%d')}.parquet"
-
-        if Path(source1).is_file():   
-            # If the parquet file that contains today's date exists, read and manipulate it.
-            stocks_current_execution_day = pl.scan_parquet(source1).select(pl.col('articleId'),
-                                                                                pl.col('branch').cast(pl.String),
-                                                                                pl.col('size'),
-                                                                                pl.col('sizeIndex'),
-                                                                                pl.col('amount').alias('current_amount'),
-                                                                                pl.col('creDate').alias('current_amount_date'))
-
-            return stocks_current_execution_day.collect()
+    def _stocks_path(self, day) -> str:
+        return f"/usr/local/airflow/include/data/{self.customerId}/stocks/{day.strftime('%Y')}/{day.strftime('%B')}/{day.strftime('%d')}"
+
+    def scan_stocks_files(self, day=None) -> pl.LazyFrame:
+        """Lazily scans today's fetched stock (the last execution of the dag).
+        Args:
+            day (date, optional): The day of the snapshot. Defaults to the current execution date.
+        Returns:
+            pl.LazyFrame: A LazyFrame with the columns articleId, branch, size, sizeIndex, current_amount and current_amount_date.
+        """
+        day = self.current_execution_date if day is None else day
+        source_path = self._stocks_path(day)
+        source_name = day.strftime('%Y%m%d')
+
+        month_file = Path(source_path).parent.joinpath(f"stocks_{day.strftime('%Y%m')}.parquet")
+
+        if resolve_artifact(source_path, source_name) is not None:   
+            # If the file that contains today's date exists, read and manipulate it.
+                # The Arrow IPC copy written by task 1 is memory-mapped when available, otherwise the parquet archive is decoded.
+            stocks = scan_stock_artifact(source_path, source_name)
+        elif month_file.is_file():
+            # Days of months compacted by the data lake maintenance.
+            stocks = pl.scan_parquet(month_file).filter(pl.col('snapshot_date') == day)
         else:   
             # If the parquet file does not exist, it would raise an error. 
             # reasons:
                 # - The DAG has just run and but the data have not been save on the destination path.
                 # - The data has been deleted or moved.
-            raise FileNotFoundError(f"\033[31mNo stock data found for the current execution date: {self.curent_date_str}\033[0m")
+            raise FileNotFoundError(f"\033[31mNo stock data found for the execution date: {day}\033[0m")
+
+        return stocks.select(pl.col('articleId'),
+                             pl.col('branch').cast(pl.String),
+                             pl.col('size'),
+                             pl.col('sizeIndex'),
+                             pl.col('amount').alias('current_amount'),
+                             pl.col('creDate').alias('current_amount_date'))
+
+    def read_parquet_stocks_files(self) -> pl.DataFrame:
+        # Read today's fetched stock (the last execution of the dag) parquet files.
+        return self.scan_stocks_files().collect()
 
     def _create_pivoted_stocks(self, articleIds: list[int]) -> pl.DataFrame:
         """Creates a pivoted DataFrame for the given article IDs. 
@@ -163,10 +210,40 @@ class stocksDatabase(customer_stocks):
         print(f"PID {pid} finished batch of size {len(articleIds)} in {exec_time:.2f} sec")  
         return df
     
-    def daily_stocks(self) -> pl.DataFrame:
+    @staticmethod
+    def _pivot_schema(columns: list[str]) -> dict:
+        """Defines the schema of the pivoted stocks.
+        Args:
+            columns (list[str]): The columns of the joined DataFrame.
+        Returns:
+            dict: A mapping of column names to polars data types.
+        """
+        letters = tuple("0123456789")
+        # Int16 like the stock cube, amounts above 127 are real stock (e.g. of the central warehouse) and must not wrap around.
+        schema = { col: pl.Int16 for col in columns if col.startswith(letters)}
+        schema['size'] = pl.Int16
+        schema['sizeIndex'] = pl.Int16
+        schema['current_amount'] = pl.Int16
+        # The store matrix of the normalized mode has no sizeIndex and current_amount columns.
+        return {col: dtype for col, dtype in schema.items() if col in columns}
+
+    def daily_stocks(self, streaming: bool = False, memory_budget_mb: float | None = None) -> pl.DataFrame:
+        """Daily stock of all stores.
+        Args:
+            streaming (bool, optional): If True, only a lazy plan is built which is executed by the streaming engine in save(). Defaults to False.
+            memory_budget_mb (float, optional): If given, the articles are pivoted and joined in bounded batches which are spilled to disk
+                when the budget is approached. Defaults to None.
+        Returns:
+            self: The instance itself to allow chaining with save().
+        """
+        if memory_budget_mb is not None:
+            return self.daily_stocks_within_budget(memory_budget_mb=memory_budget_mb)
+        if streaming:
+            return self.daily_stocks_lazy()
+
         num_cores = os.cpu_count()
         self.df = self.read_parquet_stocks_files()      
-        print(f"Dataframe read from parquet files: {self.df}")         
+        print(f"Dataframe read from parquet files: {self.df.height} rows, {self.df['articleId'].n_unique()} articles")         
 
         if not self.df.is_empty():
             # Proceed only if the DataFrame is not empty.
@@ -176,36 +253,159 @@ class stocksDatabase(customer_stocks):
             results = Parallel(n_jobs=num_cores, backend="threading")(
                                     delayed(self._create_pivoted_stocks)(chunk) for chunk in chunks        
         ) 
-        print(f"results: {pl.concat(results) }")
         # Combine the results from all parallel processes.
         self.results = pl.concat(results)   
+        print(f"results: {self.results.height} pivoted rows, {self.results.width - 2} stores")
 
-        join_df = self.df.lazy().join(self.results.lazy(), on=['articleId', 'size'], how='left').collect()
-        # Define schema for dataframe.
-        letters = tuple("0123456789")
-        schema = { col: pl.Int8 for col in join_df.columns if col.startswith(letters)}
-        schema['size'] = pl.Int16
-        schema['sizeIndex'] = pl.Int16
-        schema['current_amount'] = pl.Int8
-        self.join_df = join_df.cast(schema)
+        if self.storage_mode == 'normalized':
+            # Only the article/size x store matrix is saved, the long snapshot is already stored by task 1.
+            join_df = self.results
+        else:
+            join_df = self.df.lazy().join(self.results.lazy(), on=['articleId', 'size'], how='left').collect()
+        # Define schema for dataframe, sorted by article so that the article index finds every article in one row group.
+        self.join_df = join_df.cast(self._pivot_schema(join_df.columns)).sort('articleId')
         
         return self
 
+    def daily_stocks_lazy(self):
+        """Builds one lazy plan from the scan of today's snapshot through pivot, join and casting.
+            Nothing is materialized here, save() sinks the plan with the streaming engine so the peak memory follows the chunk size.
+        Returns:
+            self: The instance itself to allow chaining with save().
+        """
+        stocks = self.scan_stocks_files()
+        # The pivot columns must be known upfront for a lazy plan, only the branch column is read for that.
+        branches = sorted(stocks.select(pl.col('branch').unique()).collect()['branch'].drop_nulls().to_list())
+        print(f"Building lazy pivot plan for {len(branches)} stores")
+        self.plan = self._pivot_join_plan(stocks, branches)
+        return self
+
+    def _pivot_join_plan(self, stocks: pl.LazyFrame, branches: list[str]) -> pl.LazyFrame:
+        """Lazy pivot of the stocks on branch joined back onto the stocks, in normalized storage mode the pivot alone.
+        Args:
+            stocks (pl.LazyFrame): The stocks returned by scan_stocks_files(), possibly filtered.
+            branches (list[str]): All branches, the columns of the pivot.
+        Returns:
+            pl.LazyFrame: The joined and casted plan.
+        """
+        # Lazy equivalent of pivot(on='branch', index=['size', 'articleId'], values='current_amount').
+        pivot = (stocks.group_by(['size', 'articleId'])
+                        .agg([pl.col('current_amount').filter(pl.col('branch') == branch).first().alias(branch) for branch in branches]))
+
+        # Sorted by article so that the article index finds every article in one row group, the budget chunks are
+            # sorted one by one and follow each other in article order.
+        if self.storage_mode == 'normalized':
+            return pivot.cast(self._pivot_schema(['articleId', 'size'] + branches)).sort('articleId')
+
+        join_columns = stocks.collect_schema().names() + branches
+        return (stocks.join(pivot, on=['articleId', 'size'], how='left')
+                        .cast(self._pivot_schema(join_columns))
+                        .sort('articleId'))
+
+    def daily_stocks_within_budget(self, memory_budget_mb: float):
+        """Pivots and joins the articles in bounded chunks, the chunks are spilled to disk when the memory budget is approached.
+            The snapshot is streamed once into article range buckets on disk, every chunk is read from one bucket only.
+        Args:
+            memory_budget_mb (float): The memory budget in MB.
+        Raises:
+            MemoryError: If the task takes more memory than the budget although the chunks are shrunk.
+        Returns:
+            self: The instance itself to allow chaining with save().
+        """
+        baseline_mb = current_memory_mb()
+        budget_bytes = memory_budget_mb * 1024 ** 2
+        stocks = self.scan_stocks_files()
+        branches = sorted(stocks.select(pl.col('branch').unique()).collect()['branch'].drop_nulls().to_list())
+        n_rows, first_article, last_article = stocks.select(pl.len(), pl.col('articleId').min(), pl.col('articleId').max()).collect().row(0)
+
+        # First guess of the size of a pivoted row, it is corrected by every chunk. One chunk may take at most a quarter of the budget.
+        bytes_per_row = 8 * len(stocks.collect_schema()) + 2 * len(branches)
+        n_buckets = min(1000, max(1, int(np.ceil(n_rows * bytes_per_row / (budget_bytes * 0.25)))))
+        span = (last_article - first_article + 1) if n_rows else 1
+
+        spill_path = Path(f"/usr/local/airflow/include/data/{self.customerId}/spill/pivot_{self.current_execution_date.strftime('%Y%m%d')}")
+        self.buffer = spill_buffer(spill_path, budget_mb=memory_budget_mb)
+        spill_path.mkdir(parents=True, exist_ok=True)
+        staged_path = spill_path.joinpath("stocks.arrow")
+        buckets_path = spill_path.joinpath("by_article")
+        # Both steps stream, the staged file is written batch by batch and the dataset writer appends every batch to the file of its bucket.
+        (stocks.with_columns(((pl.col('articleId') - first_article) * n_buckets // span).fill_null(0).cast(pl.Int32).alias('bucket'))
+               .sink_ipc(staged_path, compression=None))
+        ds.write_dataset(ds.dataset(staged_path, format="ipc"), buckets_path, format="ipc",
+                         partitioning=["bucket"], basename_template="part-{i}.arrow", max_open_files=n_buckets + 1)
+        staged_path.unlink()
+        self._check_memory(baseline_mb, memory_budget_mb)
+
+        n_articles = 0
+        buckets = sorted(int(folder.name) for folder in buckets_path.iterdir()) if buckets_path.exists() else []
+        for bucket in buckets:
+            part = pl.scan_ipc(buckets_path.joinpath(str(bucket), "*.arrow"))
+            rows_per_article = part.group_by('articleId').agg(pl.len().alias('n_rows')).sort('articleId').collect()
+            n_articles += rows_per_article.height
+            start = 0
+            while start < rows_per_article.height:
+                # The chunk is shrunk when the memory in use approaches the budget.
+                max_rows = max(1, int(budget_bytes * 0.25 / bytes_per_row))
+                if current_memory_mb() - baseline_mb > memory_budget_mb * 0.75:
+                    max_rows = max(1, max_rows // 2)
+                stop = start + max(1, int(np.searchsorted(rows_per_article['n_rows'][start:].cum_sum().to_numpy(), max_rows, side='right')))
+                articles = part if (start == 0 and stop >= rows_per_article.height) else part.filter(pl.col('articleId').is_in(rows_per_article['articleId'][start:stop].implode()))
+                df = self._pivot_join_plan(articles, branches).collect()
+                if not df.is_empty():
+                    bytes_per_row = max(1, df.estimated_size() / df.height)
+                self.buffer.add(df)
+                self._check_memory(baseline_mb, memory_budget_mb)
+                start = stop
+        shutil.rmtree(buckets_path, ignore_errors=True)
+        print(f"{n_articles} articles of {n_buckets} article ranges pivoted within a memory budget of {memory_budget_mb} MB, peak memory so far: {peak_memory_mb():.0f} MB")
+        self.plan = self.buffer.to_lazy()
+        return self
+
+    @staticmethod
+    def _check_memory(baseline_mb: float, memory_budget_mb: float) -> None:
+        """Fails the task if it took more memory than the budget on top of the memory in use when it started."""
+        used_mb = peak_memory_mb() - baseline_mb
+        if used_mb > memory_budget_mb:
+            raise MemoryError(f"\033[31mThe pivot took {used_mb:.0f} MB, more than its memory budget of {memory_budget_mb} MB\033[0m")
+
+    def _pivot_file_name(self, day) -> str:
+        prefix = PIVOT_ARTIFACTS[self.storage_mode]
+        return f"{prefix}_{day.strftime('%Y%m%d')}"
+
+    def scan_pivot(self, day, stores: list[str] | None = None) -> pl.LazyFrame:
+        """Lazily reads the wide view of a day's stocks (one row per article, size and branch with one column per store).
+            Days saved in wide mode are read from the pivotArtStoresStock file, days saved in normalized mode
+            are built from the long snapshot joined with the store matrix, only the requested store columns are read.
+        Args:
+            day (date): The day of the snapshot.
+            stores (list[str], optional): The store columns to read. Defaults to all stores.
+        Returns:
+            pl.LazyFrame: The wide view.
+        """
+        path = self._stocks_path(day)
+        storage_mode, artifact = resolve_pivot(path, day)
+        if storage_mode is None:
+            raise FileNotFoundError(f"\033[31mNo pivotArtStoresStock or pivotMatrix file found for {day} at {path}\033[0m")
+        pivot = pl.scan_ipc(artifact) if artifact.suffix == ".arrow" else pl.scan_parquet(artifact)
+        if storage_mode == 'wide':
+            return pivot
+        if stores is not None:
+            pivot = pivot.select(['articleId', 'size'] + stores)
+        stocks = self.scan_stocks_files(day)
+        stocks = stocks.cast(self._pivot_schema(stocks.collect_schema().names()))
+        return stocks.join(pivot, on=['articleId', 'size'], how='left')
+
     def two_daily_stock_changes(self):
         # Compare stock changes between two days.
         # Proceed only if there is a day before to compare with.
         if self.a_day_before:
-            # Find the path where the previous DAG run stored stock parquet files in.
-            current_execution_date_path = f"/usr/local/airflow/include/data/{self.customerId}/stocks/{self.current_execution_date.strftime('%Y')}/{self.current_execution_date.strftime('%B')}/{self.current_execution_date.strftime('%d')}"
-            # Find the path where the two DAG run prior created the stock parquet files.
-            a_day_before_path = f"/usr/local/airflow/include/data/{self.customerId}/stocks/{self.a_day_before.strftime('%Y')}/{self.a_day_before.strftime('%B')}/{self.a_day_before.strftime('%d')}"
+            # The pivots of both days are resolved by scan_pivot() in the storage mode they were saved in.
             # read only data of stores that are active for the customer.
             active_stores = pl.scan_parquet(Path(f"/usr/local/airflow/include/data/{self.customerId}/activeStors_{self.customerId}.parquet")).collect()        
             active_stores_list = list(active_stores.row(0))
             active_stores_except_warehous = list(active_stores.select(pl.all().exclude(self.center_warehous_id)).row(0))         
             
-            pre_pivot_path = Path(a_day_before_path).joinpath("pi*.parquet")         
-            pre_pivot = (pl.scan_parquet(pre_pivot_path)
+            pre_pivot = (self.scan_pivot(self.a_day_before, stores=active_stores_list)
                                                     .filter(pl.col("branch").is_in(active_stores_except_warehous))
                                                     .select(["articleId", "branch", "size", "sizeIndex", "current_amount","current_amount_date"] + active_stores_list)
                                                     .collect())
@@ -215,8 +415,7 @@ class stocksDatabase(customer_stocks):
             new_col_names["current_amount"] = "pre_amount"
             pre_pivot = pre_pivot.rename(new_col_names)         
             
-            curr_pivot_path = Path(current_execution_date_path).joinpath("pi*.parquet")
-            curr_pivot = (pl.scan_parquet(curr_pivot_path)
+            curr_pivot = (self.scan_pivot(self.current_execution_date, stores=active_stores_list)
                                                     .filter(pl.col("branch").is_in(active_stores_except_warehous))
                                                     .select(["articleId", "branch", "size", "sizeIndex", "current_amount","current_amount_date"] + active_stores_list)
                                                     .collect())
@@ -239,25 +438,101 @@ class stocksDatabase(customer_stocks):
             path = check_Path_exits(root_name="stocks", customerId=self.customerId, current_year=self.current_execution_date.strftime('%Y'),
                                                                                 current_month=self.current_execution_date.strftime('%B'),
                                                                                 current_day=self.current_execution_date.strftime('%d'))
+            # The caller appends the changes to the change feed once they are saved.
             return Wrapper(df2.collect(), path=path,
                            file_name=f"dailyStockChanges_{self.current_execution_date.strftime('%Y%m%d')}_vs_{self.a_day_before.strftime('%Y%m%d')}")
         else:
             print(f"\033[33mthere is no pivotArtStoresStock parquet file before day`s{self.current_execution_date} for the customer {self.customerId}, skipping this time.\033[0m")
             return Wrapper(pl.DataFrame(), path="No_path", file_name="No_file")
 
+    def replenishment_candidates(self, cover_days: float = 3, min_stock: int = 1, warehouse_reserve: int = 0):
+        """Finds the articles and sizes a store is out of stock or below a sales-derived threshold of while the central warehouse has stock,
+            and allocates the warehouse stock to these stores, the stores with the most sales first.
+            The threshold is the sales of the day before times cover_days, at least min_stock. Sales sizes (custSizeId) are matched with the stock size.
+        Args:
+            cover_days (float, optional): Number of days the stock of a store should cover at the sales of the day before. Defaults to 3.
+            min_stock (int, optional): Stock every store should have of the articles it lists. Defaults to 1.
+            warehouse_reserve (int, optional): Stock of an article/size that stays in the warehouse. Defaults to 0.
+        Returns:
+            Wrapper: The transfers with the columns articleId, size, branch, stock, sales, threshold, need, warehouse_stock and transfer.
+        """
+        day = self.current_execution_date
+        path = check_Path_exits(root_name="stocks", customerId=self.customerId, current_year=day.strftime('%Y'),
+                                                                            current_month=day.strftime('%B'),
+                                                                            current_day=day.strftime('%d'))
+        # activeStors maps custStoreId (sales) -> store number (the branch of the stock).
+        active_stores = pl.read_parquet(Path(f"/usr/local/airflow/include/data/{self.customerId}/activeStors_{self.customerId}.parquet"))
+        branches = (active_stores.unpivot(variable_name="custStoreId", value_name="branch")
+                                 .with_columns(pl.col("custStoreId").cast(pl.Int32), pl.col("branch").cast(pl.String)))
+        stores = [branch for branch in branches["branch"].to_list() if branch != self.center_warehous]
+
+        # The warehouse column of the pivot holds the warehouse stock of the article/size on every store row.
+        pivot = self.scan_pivot(day, stores=[self.center_warehous])
+        file_name = f"replenishmentCandidates_{day.strftime('%Y%m%d')}"
+        if self.center_warehous not in pivot.collect_schema().names():
+            print(f"\033[33mThe central warehouse {self.center_warehous} has no stock on {day}, no replenishment candidates.\033[0m")
+            return Wrapper(pl.DataFrame(schema=self.candidates_schema), path=path, file_name=file_name)
+        stock = (pivot.filter(pl.col("branch").is_in(stores))
+                        .select(pl.col("articleId").cast(pl.Int64), pl.col("size").cast(pl.Int16), pl.col("branch"),
+                                pl.col("current_amount").cast(pl.Int32).alias("stock"),
+                                pl.col(self.center_warehous).cast(pl.Int32).alias("warehouse_stock")))
+
+        if self.a_day_before:
+            try:
+                sales = (read_sales(self.customerId, self.a_day_before)
+                                .join(branches.lazy(), on="custStoreId")
+                                .group_by(["custArtId", "custSizeId", "branch"])
+                                .agg(pl.col("num_daily_sales").sum().cast(pl.Int32).alias("sales"))
+                                .select(pl.col("custArtId").cast(pl.Int64).alias("articleId"), pl.col("custSizeId").cast(pl.Int16).alias("size"),
+                                        pl.col("branch"), pl.col("sales")))
+            except FileNotFoundError:
+                print(f"\033[33mWARNING no sales found for {self.a_day_before}, the threshold is min_stock for all stores.\033[0m")
+                sales = pl.LazyFrame(schema={"articleId": pl.Int64, "size": pl.Int16, "branch": pl.String, "sales": pl.Int32})
+        else:
+            sales = pl.LazyFrame(schema={"articleId": pl.Int64, "size": pl.Int16, "branch": pl.String, "sales": pl.Int32})
+
+        key = ["articleId", "size"]
+        candidates = (stock.join(sales, on=key + ["branch"], how="left")
+                            .with_columns(pl.col("sales").fill_null(0), pl.col("stock").fill_null(0), pl.col("warehouse_stock").fill_null(0))
+                            .with_columns(pl.max_horizontal(pl.lit(min_stock, dtype=pl.Int32), (pl.col("sales") * cover_days).ceil().cast(pl.Int32)).alias("threshold"))
+                            .with_columns((pl.col("threshold") - pl.col("stock").clip(lower_bound=0)).alias("need"))
+                            .filter(pl.col("need") > 0, pl.col("warehouse_stock") > warehouse_reserve)
+                            # Allocation by cumulative need: within an article/size the stores are served by sales, every store gets
+                                # what is left of the warehouse stock after the stores before it, at most its need.
+                            .sort(key + ["sales", "need", "branch"], descending=[False, False, True, True, False])
+                            .with_columns((pl.col("warehouse_stock") - warehouse_reserve - (pl.col("need").cum_sum().over(key) - pl.col("need"))).alias("available"))
+                            .with_columns(pl.min_horizontal(pl.col("need"), pl.col("available")).alias("transfer"))
+                            .filter(pl.col("transfer") > 0)
+                            .select(key + ["branch", "stock", "sales", "threshold", "need", "warehouse_stock", "transfer"])
+                            .collect())
+        print(f"\033[32m{candidates.height} replenishment candidates on {day}: {candidates['transfer'].sum()} pieces for "
+              f"{candidates.select(key).n_unique()} articles/sizes and {candidates['branch'].n_unique()} stores\033[0m")
+        return Wrapper(candidates, path=path, file_name=file_name)
+
     def save(self, path=None):
+        file_name = self._pivot_file_name(self.current_execution_date)
         if path is None:
-            file_name = f"pivotArtStoresStock_{self.current_execution_date.strftime('%Y%m%d')}"
-            
             path = check_Path_exits(root_name="stocks", customerId=self.customerId, current_year=self.current_execution_date.strftime('%Y'),
                                                                                 current_month=self.current_execution_date.strftime('%B'),
                                                                                 current_day=self.current_execution_date.strftime('%d'))
 
             Path(path).mkdir(parents=True, exist_ok=True)
 
-        if Path(f"{path}/{file_name}.parquet").is_file():
-                Path(f"{path}/{file_name}.parquet").unlink()         
-
-        self.join_df.write_parquet(f"{path}/{file_name}.parquet")
-        print(f"\033[32mStocks data saved on: {path} as {file_name}.parquet\033[0m")
-    
+        # The pivot of an earlier run of the day is replaced by a new version, the diff task reading it meanwhile keeps reading the old version.
+        if getattr(self, "plan", None) is not None:
+            # Streaming and memory budget mode: the lazy plan is executed once by the streaming engine into the parquet archive.
+            parquet_path, _ = sink_stock_artifact(self.plan, path=path, file_name=file_name, row_group_size=PIVOT_ROW_GROUP_SIZE)
+            if getattr(self, "buffer", None) is not None:
+                self.buffer.cleanup()
+                print(f"\033[32mPeak memory of the pivot task: {peak_memory_mb():.0f} MB (budget {self.buffer.budget_mb} MB)\033[0m")
+        else:
+            # The diff task reads today's pivot from the Arrow IPC copy instead of decoding the parquet again.
+            parquet_path = write_stock_artifact(self.join_df, path=path, file_name=file_name, row_group_size=PIVOT_ROW_GROUP_SIZE)
+        # Sidecar index articleId -> row groups for stock_lookup, it belongs to this version of the pivot.
+        build_article_index(parquet_path)
+        # A day saved before in the other storage mode would otherwise keep its old pivot next to the new one.
+        for storage_mode, prefix in PIVOT_ARTIFACTS.items():
+            if storage_mode != self.storage_mode:
+                retire_artifact(path, f"{prefix}_{self.current_execution_date.strftime('%Y%m%d')}")
+        # Dense int16 copy of the snapshot for array diffs and store vectors over many days.
+        stock_cube(self.customerId).build(self.current_execution_date, self.scan_stocks_files())
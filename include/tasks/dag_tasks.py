@@ -1,23 +1,71 @@
-from plugins.g_utils import *
-from include.stock_api import stock_api
-from include.sales import salesDatabase
-from include.stocks import stocksDatabase
+# The classes are imported inside the task functions, so a task only imports what it runs (e.g. the sales task never imports joblib or requests).
 
 customer = '22001'
 
 # Task 1
-def get_stockes_from_api(customer: str):
-    stock_api(customer=customer).get_stockes_from_api()          
+def get_stockes_from_api(customer: str, concurrency: dict | None = None, memory_budget_mb: float | None = None, deadline: str | None = None):
+    from include.stock_api import stock_api
+    stock_api(customer=customer, concurrency=concurrency, memory_budget_mb=memory_budget_mb, deadline=deadline).get_stockes_from_api()          
+
+# Task 1, follow-up pass of a crawl with deadline
+def complete_stock_crawl(customer: str, concurrency: dict | None = None, streaming: bool = False, memory_budget_mb: float | None = None, storage_mode: str = 'wide'):
+    from include.stock_api import stock_api
+    from include.stocks import stocksDatabase
+    if stock_api(customer=customer, concurrency=concurrency).complete_pending():
+        # The pivot, the daily stock changes (and their change feed records) and the replenishment candidates of the day
+            # were computed from the partial snapshot, they are redone from the completed one.
+        stocksDatabase(customerId=customer, storage_mode=storage_mode).daily_stocks(streaming=streaming, memory_budget_mb=memory_budget_mb).save()
+        stock_diff(customer=customer)
+        replenishment(customer=customer)
     
+# Task 1, sharded mode
+def plan_stock_shards(customer: str, num_shards: int) -> list[dict]:
+    from include.stock_api import stock_api
+    return stock_api(customer=customer).plan_shards(num_shards=num_shards)
+
+def fetch_stock_shard(customer: str, shard: int, num_shards: int, current_timestamp: str, concurrency: dict | None = None) -> dict:
+    from include.stock_api import stock_api
+    return stock_api(customer=customer, concurrency=concurrency).fetch_shard(shard=shard, num_shards=num_shards, current_timestamp=current_timestamp)
+
+def merge_stock_shards(customer: str, shards: list[dict], parts: list[dict]):
+    from include.stock_api import stock_api
+    stock_api(customer=customer).merge_shards(parts=list(parts), num_shards=shards[0]["num_shards"], current_timestamp=shards[0]["current_timestamp"])
+
 # Task 2
-def get_article_stock_all_stores(customer: str) -> pl.DataFrame:           
-    stocksDatabase(customerId=customer).daily_stocks().save()
+def get_article_stock_all_stores(customer: str, streaming: bool = False, memory_budget_mb: float | None = None, storage_mode: str = 'wide') -> None:           
+    from include.stocks import stocksDatabase
+    stocksDatabase(customerId=customer, storage_mode=storage_mode).daily_stocks(streaming=streaming, memory_budget_mb=memory_budget_mb).save()
 
 #Task 3
 def get_today_transactionSales(customer: str):        
-    salesDatabase(customerId=customer).daily_sales().save()
+    from include.sales import salesDatabase
+    sales = salesDatabase(customerId=customer).daily_sales()
+    sales.save()
+    sales.update_rollups()
 
 # Task 4
 def stock_diff(customer: str = customer):
-    stocksDatabase(customerId=customer).two_daily_stock_changes().save()
-    
\ No newline at end of file
+    from include.change_feed import stock_change_feed
+    from include.stocks import stocksDatabase
+    stocks = stocksDatabase(customerId=customer)
+    changes = stocks.two_daily_stock_changes()
+    changes.save()
+    # Only saved changes are published, downstream consumers pull them incrementally from the change feed.
+    if stocks.a_day_before:
+        stock_change_feed(customer).append(changes.values, day=stocks.current_execution_date, previous_day=stocks.a_day_before)
+    
+# Task 5
+def replenishment(customer: str = customer):
+    from include.stocks import stocksDatabase
+    stocksDatabase(customerId=customer).replenishment_candidates().save()
+
+# Maintenance
+def maintain_data_lake(customer: str = customer):
+    from include.maintenance import data_lake_maintenance
+    data_lake_maintenance(customer=customer).run()
+
+# Replay
+def replay_stocks(customer: str, first_date: str, last_date: str, n_jobs: int | None = None, storage_mode: str = 'wide'):
+    from datetime import date
+    from include.replay import replay_history
+    replay_history(customer=customer, first=date.fromisoformat(first_date), last=date.fromisoformat(last_date), n_jobs=n_jobs, storage_mode=storage_mode)
@@ -1,5 +1,9 @@
+import os
+import re
+import fcntl
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import polars as pl 
 from sqlalchemy import create_engine 
@@ -19,10 +23,171 @@ def check_Path_exits(root_name: str, customerId: str, current_year: str, current
     return directory_path 
 
 # Get current date details
-def get_current_date():     
-    date = datetime.now()
+def get_current_date(date: datetime | None = None):     
+    # An explicit date is used by tasks which have to agree on the date of a run, e.g. the shards of the stock crawl.
+    if date is None:
+        date = datetime.now()
     return date.strftime('%Y-%m-%d %H:%M:%S'), date.strftime('%Y-%m-%d'), date.strftime("%Y%m%d"), date.strftime('%Y'), date.strftime('%B'), date.strftime('%d')
 
+# Write a file atomically: the data is written to a temporary file next to the target, flushed to disk and renamed over the target.
+    # Readers and overlapping runs see either the old or the new file, never a partly written one.
+@contextmanager
+def atomic_path(target):
+    target = Path(target)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    try:
+        yield tmp
+        with open(tmp, "rb") as tmp_file:
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp, target)
+        # The rename is only durable once the folder itself is flushed.
+        folder_fd = os.open(target.parent, os.O_RDONLY)
+        try:
+            os.fsync(folder_fd)
+        finally:
+            os.close(folder_fd)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+# Exclusive lock on a file of a folder, held by overlapping runs (reruns, backfills, the daily DAG) while they update a shared file.
+@contextmanager
+def folder_lock(path, name: str):
+    with open(Path(path).joinpath(name), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Every day folder has a manifest which points to the published version of each artifact (snapshot, pivot, daily stock changes).
+    # Every write goes to files with a version of their own, {artifact}.{version}.parquet and .arrow, nothing is overwritten in place.
+    # Writers flip the pointer to the pair once the files are written, readers resolve the artifact through it.
+    # Files written before the versions existed are named {artifact}.parquet, the pivots have an article index {artifact}.{version}.index.parquet.
+PUBLISH_MANIFEST = "publish_manifest.parquet"
+PUBLISH_MANIFEST_SCHEMA = {"artifact": pl.String, "parquet": pl.String, "ipc": pl.String, "n_rows": pl.Int64, "published": pl.Datetime}
+ARTIFACT_FILE = re.compile(r"^(?P<artifact>.+?)(?P<version>\.v\d+p\d+)?(?P<suffix>\.parquet|\.arrow|\.index\.parquet)$")
+
+def new_artifact_version() -> str:
+    return f"v{datetime.now().strftime('%Y%m%d%H%M%S%f')}p{os.getpid()}"
+
+# All files of an artifact in a folder, every version and the file without version.
+def artifact_files(path, file_name: str) -> list[Path]:
+    files = []
+    for file in Path(path).iterdir():
+        match = ARTIFACT_FILE.match(file.name)
+        if match and match["artifact"] == file_name:
+            files.append(file)
+    return files
+
+def publish_artifact(path, file_name: str, parquet: Path, ipc: Path | None = None, n_rows: int | None = None) -> None:
+    manifest_path = Path(path).joinpath(PUBLISH_MANIFEST)
+    entry = pl.DataFrame([{"artifact": file_name, "parquet": Path(parquet).name, "ipc": Path(ipc).name if ipc is not None else None,
+                           "n_rows": n_rows, "published": datetime.now()}], schema=PUBLISH_MANIFEST_SCHEMA)
+    with folder_lock(path, "publish_manifest.lock"):
+        manifest = pl.read_parquet(manifest_path) if manifest_path.is_file() else pl.DataFrame(schema=PUBLISH_MANIFEST_SCHEMA)
+        replaced = manifest.filter(pl.col("artifact") == file_name)
+        manifest = pl.concat([manifest.filter(pl.col("artifact") != file_name), entry])
+        with atomic_path(manifest_path) as tmp:
+            manifest.write_parquet(tmp)
+        # The replaced version is kept for readers which resolved it just before the flip, older versions are deleted.
+        keep = {name for row in pl.concat([entry, replaced]).iter_rows(named=True) for name in (row["parquet"], row["ipc"]) if name is not None}
+        keep |= {name.removesuffix(".parquet") + ".index.parquet" for name in keep}
+        if replaced.is_empty():
+            # First versioned publish of an artifact written before the versions existed, its unversioned files are kept for one cycle.
+            keep |= {f"{file_name}.parquet", f"{file_name}.arrow", f"{file_name}.index.parquet"}
+        for file in artifact_files(path, file_name):
+            if file.name not in keep:
+                file.unlink(missing_ok=True)
+    print(f"\033[32m{file_name} published on {path} as {entry['parquet'][0]}\033[0m")
+
+# Resolve the file an artifact is read from, None if it does not exist. ipc=False only returns the parquet file (e.g. for pyarrow).
+def resolve_artifact(path, file_name: str, ipc: bool = True) -> Path | None:
+    manifest_path = Path(path).joinpath(PUBLISH_MANIFEST)
+    if manifest_path.is_file():
+        entry = pl.read_parquet(manifest_path).filter(pl.col("artifact") == file_name)
+        if not entry.is_empty():
+            # The Arrow IPC copy may have been expired by the maintenance, the parquet archive is kept.
+            for name in ((entry["ipc"][0], entry["parquet"][0]) if ipc else (entry["parquet"][0],)):
+                if name is not None and Path(path).joinpath(name).is_file():
+                    return Path(path).joinpath(name)
+    # Days written before the manifest existed: only trust the .arrow copy if it is not older than the parquet file.
+    ipc_path = Path(f"{path}/{file_name}.arrow")
+    parquet_path = Path(f"{path}/{file_name}.parquet")
+    if ipc and ipc_path.is_file() and (not parquet_path.is_file() or ipc_path.stat().st_mtime >= parquet_path.stat().st_mtime):
+        return ipc_path
+    if parquet_path.is_file():
+        return parquet_path
+    return None
+
+# Remove an artifact from the manifest and delete all its files, e.g. the pivot of the other storage mode once a day is saved again.
+def retire_artifact(path, file_name: str) -> None:
+    manifest_path = Path(path).joinpath(PUBLISH_MANIFEST)
+    with folder_lock(path, "publish_manifest.lock"):
+        if manifest_path.is_file():
+            manifest = pl.read_parquet(manifest_path)
+            if manifest.filter(pl.col("artifact") == file_name).height:
+                with atomic_path(manifest_path) as tmp:
+                    manifest.filter(pl.col("artifact") != file_name).write_parquet(tmp)
+        files = artifact_files(path, file_name)
+        for file in files:
+            file.unlink(missing_ok=True)
+    if files:
+        print(f"\033[33m{file_name} retired on {path}, {len(files)} files deleted\033[0m")
+
+# The pivot of a day is saved either in wide (pivotArtStoresStock) or in normalized storage mode (pivotMatrix).
+PIVOT_ARTIFACTS = {"wide": "pivotArtStoresStock", "normalized": "pivotMatrix"}
+
+# Resolve the pivot of a day in the storage mode it was last saved in, (storage mode, file) or (None, None) if there is none.
+    # Saving a day retires the pivot of the other mode, folders written before that may hold both and the newest file wins.
+def resolve_pivot(path, day, ipc: bool = True) -> tuple[str | None, Path | None]:
+    found = {}
+    for storage_mode, prefix in PIVOT_ARTIFACTS.items():
+        artifact = resolve_artifact(path, f"{prefix}_{day.strftime('%Y%m%d')}", ipc=ipc)
+        if artifact is not None:
+            found[storage_mode] = artifact
+    if not found:
+        return None, None
+    storage_mode = max(found, key=lambda mode: found[mode].stat().st_mtime)
+    return storage_mode, found[storage_mode]
+
+# Write a DataFrame as a new version of an artifact and publish it. With ipc=True an uncompressed Arrow IPC copy is written next to the parquet file:
+    # parquet stays the durable archive, the .arrow file is only for the hand-off to the next task on the same node.
+def write_stock_artifact(df: pl.DataFrame, path, file_name: str, row_group_size: int | None = None, ipc: bool = True) -> Path:
+    version = new_artifact_version()
+    parquet_path = Path(path).joinpath(f"{file_name}.{version}.parquet")
+    with atomic_path(parquet_path) as tmp:
+        df.write_parquet(tmp, row_group_size=row_group_size)
+    ipc_path = None
+    if ipc:
+        ipc_path = Path(path).joinpath(f"{file_name}.{version}.arrow")
+        with atomic_path(ipc_path) as tmp:
+            df.write_ipc(tmp, compression="uncompressed")
+    print(f"\033[32mData saved on: {path} as {parquet_path.name}{f' and {ipc_path.name}' if ipc else ''}\033[0m")
+    publish_artifact(path, file_name, parquet=parquet_path, ipc=ipc_path, n_rows=df.height)
+    return parquet_path
+
+# Execute a lazy plan once with the streaming engine into a new version of the parquet archive and publish it.
+    # The plan is not run a second time for an Arrow IPC copy, the next task reads the parquet file with projection and predicate pushdown.
+def sink_stock_artifact(lf: pl.LazyFrame, path, file_name: str, row_group_size: int | None = None) -> tuple[Path, int]:
+    parquet_path = Path(path).joinpath(f"{file_name}.{new_artifact_version()}.parquet")
+    with atomic_path(parquet_path) as tmp:
+        lf.sink_parquet(tmp, row_group_size=row_group_size)
+    n_rows = pl.scan_parquet(parquet_path).select(pl.len()).collect().item()
+    print(f"\033[32mData streamed to: {path} as {parquet_path.name} ({n_rows} rows)\033[0m")
+    publish_artifact(path, file_name, parquet=parquet_path, n_rows=n_rows)
+    return parquet_path, n_rows
+
+# Scan a published artifact, preferring the Arrow IPC copy over the parquet archive.
+    # Polars memory-maps uncompressed IPC files on its own, the scan takes no memory_map argument (removed in polars 2).
+def scan_stock_artifact(path, file_name: str) -> pl.LazyFrame:
+    artifact = resolve_artifact(path, file_name)
+    if artifact is None:
+        raise FileNotFoundError(f"\033[31mNo {file_name} artifact found at {path}\033[0m")
+    if artifact.suffix == ".arrow":
+        print(f"\033[32mReading {file_name} from memory-mapped Arrow IPC file {artifact}\033[0m")
+        return pl.scan_ipc(artifact)
+    return pl.scan_parquet(artifact)
+
 
 def get_last_two_working_days(customerId: str):
         last_20_executions_date = (pl.scan_parquet(f"/usr/local/airflow/include/data/{customerId}/last_20_executions_date.parquet")
@@ -37,7 +202,7 @@ def get_last_two_working_days(customerId: str):
         if current_date not in last_20_executions_date['date'].to_list() :
              assert f"\033[31mThe current date {current_date} is not in the last_20_executions_date list, please check the last_20_executions_date.parquet file.\033[0m"
 
-        if not Path(f"{last_execution_date_path}/{current_date.strftime('%Y%m%d')}.parquet").is_file():
+        if resolve_artifact(last_execution_date_path, current_date.strftime('%Y%m%d')) is None:
             print(f"\033[33mStock data for the current execution date {current_date} already does not exist at {last_execution_date_path}, looking for the last two working days before {current_date}.\033[0m")
 
         print(f"\033[32mCurrent execution date found: {current_date}\033[0m")
@@ -51,7 +216,7 @@ def get_last_two_working_days(customerId: str):
                 # print(i_day_before)
                 i_day_before_path = f"/usr/local/airflow/include/data/{customerId}/stocks/{i_day_before.strftime('%Y')}/{i_day_before.strftime('%B')}/{i_day_before.strftime('%d')}"
                 # print(Path(i_day_before_path).exists())
-                if i_day_before in last_20_executions_date_list and Path(f"{i_day_before_path}/{i_day_before.strftime('%Y%m%d')}.parquet").is_file(): #########################################################   
+                if i_day_before in last_20_executions_date_list and resolve_artifact(i_day_before_path, i_day_before.strftime('%Y%m%d')) is not None: #########################################################   
                     # print(i_day_before)
                     a_day_before.extend([i_day_before])
                     break
@@ -64,6 +229,26 @@ def get_last_two_working_days(customerId: str):
         else:             
             return current_date, a_day_before, i_day_before_path
 
+# Check if the stock snapshot of a day exists, either as daily file or inside the monthly file of the data lake maintenance.
+def stock_snapshot_exists(customerId: str, day) -> bool:
+    month_path = f"/usr/local/airflow/include/data/{customerId}/stocks/{day.strftime('%Y')}/{day.strftime('%B')}"
+    if resolve_artifact(f"{month_path}/{day.strftime('%d')}", day.strftime('%Y%m%d')) is not None:
+        return True
+    month_file = Path(f"{month_path}/stocks_{day.strftime('%Y%m')}.parquet")
+    return month_file.is_file() and pl.scan_parquet(month_file).filter(pl.col("snapshot_date") == day).select(pl.len()).collect().item() > 0
+
+# Find the working day before a given day: the last day with a stock snapshot, looking back at most max_days days.
+    # Unlike get_last_two_working_days it does not depend on last_20_executions_date, so it works for any day in the past.
+def get_previous_working_day(customerId: str, day, max_days: int = 20):
+    for i in range(1, max_days + 1):
+        i_day_before = day - timedelta(days=i)
+        i_day_before_path = f"/usr/local/airflow/include/data/{customerId}/stocks/{i_day_before.strftime('%Y')}/{i_day_before.strftime('%B')}/{i_day_before.strftime('%d')}"
+        if stock_snapshot_exists(customerId, i_day_before):
+            print(f"\033[32mexecution date: {day}, day before: {i_day_before}\033[0m")
+            return day, i_day_before, i_day_before_path
+    print(f"\033[33mNo stock snapshot found in the {max_days} days before {day}\033[0m")
+    return day, [], i_day_before_path
+
 def get_active_stors(customer: str):
         # TODO get active stores
         if not Path(f"/usr/local/airflow/include/stocks/{customer}/activeStors.parquet").is_file():
@@ -0,0 +1,37 @@
+from datetime import date
+
+import polars as pl
+import pytest
+
+from include.change_feed import stock_change_feed
+
+
+@pytest.fixture
+def feed(tmp_path):
+    feed = stock_change_feed(customer="test")
+    feed.root = tmp_path
+    feed.index_path = tmp_path.joinpath("index.parquet")
+    return feed
+
+
+def changes(n: int) -> pl.DataFrame:
+    return pl.DataFrame({"articleId": list(range(n)), "branch": ["1"] * n, "size": [40] * n,
+                         "pre_amount": [1] * n, "curr_amount": [2] * n})
+
+
+def test_republish_empty_day_then_another_day(feed):
+    day_a, day_b, previous_day = date(2025, 3, 3), date(2025, 3, 4), date(2025, 2, 28)
+    feed.append(changes(3), day_a, previous_day)
+    feed.append(changes(2), day_b, day_a)
+
+    # The empty replacement of day A takes no offset, the replacement of day B starts at the same offset.
+    feed.append(changes(0), day_a, previous_day)
+    feed.append(changes(4), day_b, day_a)
+
+    index = feed.index()
+    assert index["segment"].n_unique() == index.height
+    records = feed.read()
+    assert records.height == 4
+    assert records["offset"].n_unique() == 4
+    assert records["day"].unique().to_list() == [day_b]
+    assert records["revision"].unique().to_list() == [1]